@@ -0,0 +1,124 @@
+import os
+import csv
+import sys
+import time
+import random
+import argparse
+import importlib
+import multiprocessing
+
+import numpy as np
+
+import main
+
+
+class RandomPolicy(main.InputSource):
+    def __init__(self, seed=None, turn=0.05):
+        self.rng = random.Random(seed)
+        self.turn = turn
+        self.key = main.stop
+
+    def getKey(self, game):
+        if self.key == main.stop or self.rng.random() < self.turn:
+            self.key = self.rng.choice((main.up, main.down, main.left, main.right))
+        return self.key
+
+
+class GreedyPolicy(main.InputSource):
+    def __init__(self, seed=None, eps=0.1):
+        self.rng = random.Random(seed)
+        self.eps = eps
+
+    def getKey(self, game):
+        if self.rng.random() < self.eps:
+            return self.rng.choice((main.up, main.down, main.left, main.right))
+        cells = np.argwhere(game.pellets.grid)
+        if len(cells) == 0:
+            return main.stop
+        position = game.pacman.position
+        d = (cells[:, 1] * main.twidth - position.x) ** 2 + (cells[:, 0] * main.theight - position.y) ** 2
+        row, col = cells[d.argmin()]
+        gx, gy = col * main.twidth, row * main.theight
+        node = game.pacman.target
+        best, bestd = main.stop, None
+        for direction in (main.up, main.down, main.left, main.right):
+            neighbor = node.neighbors[direction]
+            if neighbor is not None and direction != -game.pacman.direction:
+                nd = (neighbor.position.x - gx) ** 2 + (neighbor.position.y - gy) ** 2
+                if bestd is None or nd < bestd:
+                    best, bestd = direction, nd
+        return best
+
+
+POLICIES = {'idle': main.InputSource, 'random': RandomPolicy, 'greedy': GreedyPolicy}
+
+
+def getPolicy(name):
+    if name in POLICIES:
+        return POLICIES[name]
+    module, cls = name.split(':')
+    return getattr(importlib.import_module(module), cls)
+
+
+def makePolicy(name, seed):
+    policy = getPolicy(name)
+    if policy is main.InputSource:
+        return policy()
+    return policy(seed)
+
+
+def runGame(task):
+    index, seed, policy, mazes, maxsteps, hz = task
+    game = main.GameController(headless=True, autostart=True, seed=seed, hz=hz, fastforward=True, mazes=mazes,
+                               inputs=makePolicy(policy, seed))
+    game.start()
+    t = time.perf_counter()
+    while not game.gameover and game.frame < maxsteps:
+        game.step()
+    return {'game': index, 'seed': seed, 'policy': policy, 'score': game.score, 'level': game.level + 1,
+            'lives_lost': game.deaths, 'steps': game.frame, 'seconds': round(time.perf_counter() - t, 4)}
+
+
+def runBatch(games, seed=0, policy='random', mazes=None, maxsteps=30 * 60 * 10, hz=30, processes=None,
+             chunksize=1):
+    tasks = [(i, seed + i, policy, mazes, maxsteps, hz) for i in range(games)]
+    if processes == 1:
+        results = [runGame(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = list(pool.imap_unordered(runGame, tasks, chunksize))
+    results.sort(key=lambda result: result['game'])
+    return results
+
+
+def writeTable(results, out):
+    fields = ['game', 'seed', 'policy', 'score', 'level', 'lives_lost', 'steps', 'seconds']
+    writer = csv.DictWriter(out, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('games', type=int, help='number of games to run')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, later games count up from it')
+    parser.add_argument('--policy', default='random', help='idle, random, greedy or module:Class')
+    parser.add_argument('--maze', action='append', choices=sorted(main.MazeData.mazes), help='maze rotation to play')
+    parser.add_argument('--max-steps', type=int, default=30 * 60 * 10, help='step limit per game')
+    parser.add_argument('--hz', type=int, default=30, help='simulation steps per second')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--chunksize', type=int, default=1)
+    parser.add_argument('--out', default=None, help='CSV file for the result table (default: stdout)')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = runBatch(args.games, args.seed, args.policy, args.maze, args.max_steps, args.hz, args.processes,
+                       args.chunksize)
+    elapsed = time.perf_counter() - start
+    if args.out is None:
+        writeTable(results, sys.stdout)
+    else:
+        with open(args.out, 'w', newline='') as out:
+            writeTable(results, out)
+    steps = sum(result['steps'] for result in results)
+    sys.stderr.write('%d games, %d steps in %.2f s (%.0f steps/s) on %d processes\n' % (
+        len(results), steps, elapsed, steps / elapsed, args.processes or os.cpu_count()))
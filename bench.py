@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import fnmatch
+import argparse
+import platform
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+
+import main
+import batch
+import env
+
+
+def summarize(times, **extra):
+    times = sorted(times)
+    result = {'us': times[0] * 1e6, 'median': times[len(times) // 2] * 1e6}
+    result.update(extra)
+    return result
+
+
+def measure(func, number, repeat, ops=1):
+    return summarize([t / (number * ops) for t in timeit.repeat(func, number=number, repeat=repeat)])
+
+
+def clearCaches():
+    main.NodeG.pathcache.clear()
+    main.MazeSprites.backgrounds.clear()
+    main.SpriteAtlas.clear()
+    main.GhostSprites.tables.clear()
+    main.GlyphAtlas.fonts.clear()
+    main.GlyphAtlas.atlases.clear()
+
+
+def makeGame(seed, **options):
+    game = main.GameController(headless=True, autostart=True, seed=seed, fastforward=True,
+                               inputs=batch.RandomPolicy(seed), **options)
+    game.start()
+    return game
+
+
+def benchLevelData(repeat):
+    maze = main.MazeData().getMaze(0)
+    return measure(lambda: main.LevelData.load(maze), 20, repeat)
+
+
+def benchNodes(repeat):
+    data = main.LevelData.load(main.MazeData().getMaze(0))
+    return measure(lambda: main.NodeG(data), 20, repeat)
+
+
+def benchBackground(repeat):
+    main.GameController(seed=0)
+    sprites = main.MazeSprites(main.LevelData.load(main.MazeData().getMaze(0)))
+    bg = pygame.Surface(main.SCREENSIZE).convert()
+    return measure(lambda: sprites.consBG(bg, 0), 10, repeat)
+
+
+def benchStart(repeat, headless):
+    game = main.GameController(headless=headless, seed=0)
+
+    def start():
+        clearCaches()
+        game.start()
+    return measure(start, 3, repeat)
+
+
+def benchGame(repeat, steps):
+    times = []
+    for i in range(repeat):
+        game = makeGame(0, autorestart=False)
+        t = time.perf_counter()
+        while not game.gameover and game.frame < steps:
+            game.step()
+        times.append((time.perf_counter() - t) / game.frame)
+    return summarize(times, steps=game.frame, score=game.score, vecs=round(countVecs(game.frame), 2))
+
+
+def countVecs(steps, seed=0):
+    game = makeGame(seed, autorestart=False)
+    init = main.vec.__init__
+    count = [0]
+
+    def counted(self, x=0, y=0):
+        count[0] += 1
+        init(self, x, y)
+    main.vec.__init__ = counted
+    try:
+        for i in range(steps):
+            game.step()
+    finally:
+        main.vec.__init__ = init
+    return count[0] / float(steps)
+
+
+def makeGhosts(count):
+    game = makeGame(0)
+    rng = random.Random(0)
+    nodes = list(game.nodes.nodesLUT.values())
+    group = game.ghosts
+    ghosts = []
+    for i in range(count):
+        proto = group.ghosts[i % 4]
+        ghost = type(proto)(rng.choice(nodes), game.pacman, group.blinky, group.mainmode)
+        ghost.setSpawnNode(proto.spawnNode)
+        ghost.paths = proto.paths
+        ghost.rng = proto.rng
+        ghosts.append(ghost)
+    return ghosts
+
+
+def benchGhosts(repeat, count):
+    ghosts = makeGhosts(count)
+    dt = 1.0 / 30
+
+    def update():
+        for ghost in ghosts:
+            ghost.update(dt)
+    return measure(update, 100, repeat)
+
+
+def benchHorde(repeat, count):
+    game = makeGame(0, horde=count)
+    dt = game.stepdt
+    return measure(lambda: game.ghosts.update(dt), 100, repeat)
+
+
+def getPath(nodes, step):
+    path = []
+    for node in nodes.nodesLUT.values():
+        for direction in (main.up, main.down, main.left, main.right):
+            neighbor = node.neighbors[direction]
+            if neighbor is not None:
+                delta = neighbor.position - node.position
+                count = int(delta.magnitude() // step)
+                for i in range(count):
+                    path.append((node.position + delta * (i / float(count)),
+                                 node.position + delta * ((i + 1) / float(count))))
+    return path
+
+
+def benchPellets(repeat, count):
+    game = makeGame(0)
+    pellets = game.pellets
+    rng = random.Random(0)
+    for pellet in rng.sample(sorted(pellets.lut.values(), key=lambda pellet: (pellet.row, pellet.col)),
+                             max(pellets.num - count, 0)):
+        pellets.removePellet(pellet)
+    path = getPath(game.nodes, game.pacman.speed * game.stepdt)
+    colrad = game.pacman.colrad
+
+    def collide():
+        for start, position in path:
+            pellets.getPellets(position, colrad, start)
+    return measure(collide, 3, repeat, len(path))
+
+
+def benchText(repeat, steps=300):
+    main.GameController(seed=0)
+    timers = main.Scheduler(1.0 / 30)
+    group = main.TextGroup(timers)
+    screen = pygame.Surface(main.SCREENSIZE)
+    score = [0]
+
+    def update():
+        for i in range(steps):
+            score[0] += 10
+            group.newScore(score[0])
+            if i % 10 == 0:
+                group.addText(str(score[0] % 1600), (255, 255, 255), 13 * main.twidth, 20 * main.theight, 8, time=1)
+            timers.update()
+            group.render(screen)
+    return measure(update, 1, repeat, steps)
+
+
+def benchRender(repeat, dirty, frames, horde=0):
+    times = []
+    for i in range(repeat):
+        game = main.GameController(dirty=dirty, seed=0, autostart=True, inputs=batch.RandomPolicy(0), horde=horde)
+        game.start()
+        elapsed = 0.0
+        for j in range(frames):
+            game.step()
+            t = time.perf_counter()
+            game.render()
+            elapsed += time.perf_counter() - t
+        times.append(elapsed / frames)
+    return summarize(times)
+
+
+def benchClone(repeat, method, clones, depth=10):
+    game = makeGame(0)
+    for i in range(1000):
+        game.step()
+    state = game.snapshot()
+    if method == 'snapshot':
+        return measure(game.snapshot, clones, repeat)
+    if method == 'restore':
+        return measure(lambda: game.restore(state), clones, repeat)
+
+    def search():
+        game.restore(state)
+        for i in range(depth):
+            game.step()
+    return measure(search, clones, repeat)
+
+
+def benchEnv(repeat, obs, steps=300):
+    gameenv = env.GameEnv(obs, seed=0)
+    rng = random.Random(0)
+    actions = [rng.randrange(gameenv.actions) for i in range(steps)]
+
+    def run():
+        gameenv.reset()
+        for action in actions:
+            if gameenv.step(action)[2]:
+                gameenv.reset()
+    return measure(run, 1, repeat, steps)
+
+
+def getSuite(frames=600, steps=20000, clones=2000):
+    suite = [('level.data', benchLevelData, {}),
+             ('level.nodes', benchNodes, {}),
+             ('level.background', benchBackground, {}),
+             ('level.start', benchStart, {'headless': False}),
+             ('level.start.headless', benchStart, {'headless': True}),
+             ('game.step', benchGame, {'steps': steps})]
+    suite += [('ghosts.update[%d]' % count, benchGhosts, {'count': count}) for count in (4, 64, 256)]
+    suite += [('horde.update[%d]' % count, benchHorde, {'count': count}) for count in (64, 256, 1024)]
+    suite += [('pellets.collide[%d]' % count, benchPellets, {'count': count}) for count in (244, 120, 10)]
+    suite += [('text.update', benchText, {}),
+              ('render.full', benchRender, {'dirty': False, 'frames': frames}),
+              ('render.dirty', benchRender, {'dirty': True, 'frames': frames})]
+    suite += [('render.%s.horde[%d]' % (name, count), benchRender,
+               {'dirty': dirty, 'frames': frames // 4, 'horde': count})
+              for count in (256, 1024) for name, dirty in (('full', False), ('dirty', True))]
+    suite += [('clone.' + method, benchClone, {'method': method, 'clones': clones})
+              for method in ('snapshot', 'restore', 'search')]
+    suite += [('env.' + obs, benchEnv, {'obs': obs}) for obs in env.OBSERVATIONS]
+    return suite
+
+
+def runSuite(suite, repeat=5, patterns=None, out=sys.stdout):
+    results = {}
+    for name, func, params in suite:
+        if patterns and not any(name == pattern or fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        results[name] = func(repeat, **params)
+        out.write('%-24s %10.2f us  median %10.2f us\n' % (name, results[name]['us'], results[name]['median']))
+        out.flush()
+    return results
+
+
+def getMeta(repeat):
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'pygame': pygame.version.ver, 'numpy': np.__version__, 'platform': platform.platform(),
+            'machine': platform.machine(), 'processor': platform.processor(), 'repeat': repeat}
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    regressions = []
+    out.write('%-24s %10s %10s %8s\n' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            out.write('%-24s %10s %10.2f %8s\n' % (name, '-', result['us'], 'new'))
+            continue
+        ratio = result['us'] / base['us']
+        status = ''
+        if ratio > 1 + threshold:
+            status = 'slower'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        if base.get('steps', result.get('steps')) != result.get('steps'):
+            status += ' (workload changed: %s -> %s steps)' % (base['steps'], result.get('steps'))
+        out.write('%-24s %10.2f %10.2f %7.2fx %s\n' % (name, base['us'], result['us'], ratio, status))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=600, help='rendered frames per render repeat')
+    parser.add_argument('--steps', type=int, default=20000, help='step limit of the full seeded game')
+    parser.add_argument('--clones', type=int, default=2000, help='snapshots/restores per clone repeat')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats per benchmark, the fastest is reported')
+    parser.add_argument('--filter', action='append', default=None, help='only run benchmarks matching this glob')
+    parser.add_argument('--list', action='store_true', help='list the benchmark names and exit')
+    parser.add_argument('--out', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare against results from an earlier --out')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown that counts as a regression (default 0.1)')
+    args = parser.parse_args()
+    suite = getSuite(args.frames, args.steps, args.clones)
+    if args.list:
+        print('\n'.join(name for name, func, params in suite))
+        exit()
+    results = runSuite(suite, args.repeat, args.filter)
+    if args.out is not None:
+        with open(args.out, 'w') as out:
+            json.dump({'meta': getMeta(args.repeat), 'results': results}, out, indent=1, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('%d regressions beyond %.0f%%: %s' % (len(regressions), args.threshold * 100,
+                                                         ', '.join(regressions)))
+            exit(1)
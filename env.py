@@ -0,0 +1,126 @@
+import os
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+
+import main
+from vecenv import ACTIONS
+
+OBSERVATIONS = ('rgb', 'gray', 'symbolic')
+DIRECTIONS = {direction: i for i, direction in enumerate(ACTIONS)}
+LUMA = (77, 150, 29)
+
+
+class GameEnv(object):
+    def __init__(self, obs='rgb', frameskip=4, scale=2, seed=None, mazes=None, hz=30, smart=False, horde=0,
+                 maxsteps=None):
+        if obs not in OBSERVATIONS:
+            raise ValueError('obs must be one of %s, not %r' % (', '.join(OBSERVATIONS), obs))
+        self.obs = obs
+        self.frameskip = frameskip
+        self.maxsteps = maxsteps
+        self.actions = len(ACTIONS)
+        self.inputs = main.ActionInput()
+        self.game = main.GameController(dirty=True, headless=obs == 'symbolic', inputs=self.inputs, autostart=True,
+                                        seed=seed, hz=hz, fastforward=True, mazes=mazes, smart=smart, horde=horde,
+                                        autorestart=False)
+        self.game.start()
+        if obs == 'symbolic':
+            self.allocateSymbolic()
+        else:
+            self.allocatePixels(scale)
+        self.initial = self.game.snapshot()
+
+    def allocatePixels(self, scale):
+        self.buffer = np.zeros((main.screenh, main.screenw, 4), dtype=np.uint8)
+        self.game.screen = pygame.image.frombuffer(self.buffer, main.SCREENSIZE, 'RGBX')
+        self.game.setRenderMode(True)
+        self.rgb = self.buffer[:, :, :3]
+        self.channels = [self.buffer[::scale, ::scale, c] for c in range(3)]
+        self.gray = np.zeros(self.channels[0].shape, dtype=np.uint8)
+        self.luma = np.zeros(self.gray.shape, dtype=np.uint16)
+        self.tmp = np.zeros(self.gray.shape, dtype=np.uint16)
+
+    def allocateSymbolic(self):
+        game = self.game
+        self.pacman = np.zeros(4, dtype=np.int32)
+        self.ghosts = np.zeros((game.horde or len(game.ghosts.ghosts), 4), dtype=np.int32)
+        self.pellets = np.zeros(game.pellets.grid.shape, dtype=bool)
+        self.state = np.zeros(4, dtype=np.int32)
+        self.symbolic = {'pacman': self.pacman, 'ghosts': self.ghosts, 'pellets': self.pellets, 'state': self.state}
+
+    def reset(self, seed=None):
+        game = self.game
+        game.restore(self.initial)
+        if seed is not None:
+            game.rng.seed(seed)
+            if game.horde:
+                game.ghosts.rng = np.random.default_rng(seed)
+        game.fruitsc = []
+        game.TG.showText(main.READYTXT)
+        if self.obs != 'symbolic':
+            game.setRenderMode(True)
+        return self.observe()
+
+    def step(self, action):
+        game = self.game
+        self.inputs.key = ACTIONS[action]
+        score = game.score
+        for i in range(self.frameskip):
+            game.step()
+            if game.gameover or (self.maxsteps is not None and game.frame >= self.maxsteps):
+                break
+        done = game.gameover or (self.maxsteps is not None and game.frame >= self.maxsteps)
+        info = {'frame': game.frame, 'lives': game.lives, 'level': game.level, 'gameover': game.gameover}
+        return self.observe(), game.score - score, done, info
+
+    def observe(self):
+        if self.obs == 'symbolic':
+            return self.observeSymbolic()
+        self.game.render()
+        if self.obs == 'gray':
+            return self.observeGray()
+        return self.rgb
+
+    def observeGray(self):
+        r, g, b = self.channels
+        np.multiply(r, LUMA[0], out=self.luma, dtype=np.uint16)
+        np.multiply(g, LUMA[1], out=self.tmp, dtype=np.uint16)
+        np.add(self.luma, self.tmp, out=self.luma)
+        np.multiply(b, LUMA[2], out=self.tmp, dtype=np.uint16)
+        np.add(self.luma, self.tmp, out=self.luma)
+        np.right_shift(self.luma, 8, out=self.gray, casting='unsafe')
+        return self.gray
+
+    def observeSymbolic(self):
+        game = self.game
+        pacman = game.pacman
+        self.pacman[0] = pacman.node.id
+        self.pacman[1] = pacman.target.id
+        self.pacman[2] = DIRECTIONS[pacman.direction]
+        self.pacman[3] = pacman.alive
+        ghosts = game.ghosts
+        if game.horde:
+            self.ghosts[:, 0] = ghosts.node
+            self.ghosts[:, 1] = ghosts.target
+            self.ghosts[:, 2] = ghosts.direction
+            self.ghosts[:, 3] = ghosts.mode
+        else:
+            for i, ghost in enumerate(ghosts):
+                self.ghosts[i, 0] = ghost.node.id
+                self.ghosts[i, 1] = ghost.target.id
+                self.ghosts[i, 2] = DIRECTIONS[ghost.direction]
+                self.ghosts[i, 3] = ghost.mode.cur
+        np.copyto(self.pellets, game.pellets.grid)
+        self.state[0] = game.score
+        self.state[1] = game.lives
+        self.state[2] = game.level
+        self.state[3] = game.fruit is not None
+        return self.symbolic
+
+    def render(self):
+        if self.obs == 'symbolic':
+            return None
+        return self.rgb
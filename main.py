@@ -1,7 +1,20 @@
 import pygame
 import os
+import json
+import csv
+import zlib
+import pickle
+import struct
+import math
+import time
+import heapq
+import hashlib
+import functools
+import tempfile
+import threading
+import argparse
 import numpy as np
-from random import randint
+import random
 twidth, theight = 16, 16
 rows_, cols_ = 36, 28
 screenw, screenh = cols_ * twidth, rows_ * theight
@@ -30,6 +43,11 @@ GAMEOVERTXT = 4
 BASETILEWIDTH = 16
 BASETILEHEIGHT = 16
 DEATH = 5
+GRAPHDIRS = (up, down, left, right, port)
+GHOSTDIRS = (up, down, left, right, stop)
+ACCESSSLOTS = {up: 0, down: 1, left: 2, right: 3}
+ALLACCESS = sum(1 << name for name in (PACMAN, bli, pin, ink, cly, fru))
+CACHELOCK = threading.RLock()
 
 
 class Animator(object):
@@ -37,6 +55,7 @@ class Animator(object):
         self.frames = frames
         self.current_frame = 0
         self.speed = speed
+        self.period = 1.0 / speed
         self.loop = loop
         self.dt = 0
         self.finished = False
@@ -58,7 +77,7 @@ class Animator(object):
 
     def nextFrame(self, dt):
         self.dt += dt
-        if self.dt >= (1.0 / self.speed):
+        if self.dt >= self.period:
             self.current_frame += 1
             self.dt = 0
 
@@ -77,14 +96,17 @@ class Entity(object):
         self.disablePortal = False
         self.goal = None
         self.directionMethod = self.randomDirection
+        self.rng = random
+        self.prev = None
         self.setStartNode(node)
         self.image = None
+        self.sprites = None
 
     def setPosition(self):
         self.position = self.node.position.copy()
 
     def update(self, dt):
-        self.position += self.directions[self.direction] * self.speed * dt
+        self.position.addScaled(self.directions[self.direction], self.speed * dt)
         if self.overshotTarget():
             self.node = self.target
             directions = self.validDirections()
@@ -100,8 +122,7 @@ class Entity(object):
             self.setPosition()
 
     def validDirection(self, direction):
-        return direction is not stop and self.name in self.node.access[direction] and \
-               self.node.neighbors[direction] is not None
+        return self.node.neighbors[direction] is not None and self.node.access[ACCESSSLOTS[direction]] >> self.name & 1
 
     def getNewTarget(self, direction):
         if self.validDirection(direction):
@@ -110,11 +131,10 @@ class Entity(object):
 
     def overshotTarget(self):
         if self.target is not None:
-            vec1 = self.target.position - self.node.position
-            vec2 = self.position - self.node.position
-            node2Target = vec1.magnitudeSquared()
-            node2Self = vec2.magnitudeSquared()
-            return node2Self >= node2Target
+            node = self.node.position
+            tx, ty = self.target.position.x - node.x, self.target.position.y - node.y
+            sx, sy = self.position.x - node.x, self.position.y - node.y
+            return sx * sx + sy * sy >= tx * tx + ty * ty
         return False
 
     def reverseDirection(self):
@@ -137,15 +157,19 @@ class Entity(object):
         return directions
 
     def randomDirection(self, directions):
-        return directions[randint(0, len(directions) - 1)]
+        return directions[self.rng.randint(0, len(directions) - 1)]
 
     def goalDirection(self, directions):
-        distances = []
+        node, goal = self.node.position, self.goal
+        best, bestd = None, None
         for direction in directions:
-            vec = self.node.position + self.directions[direction] * twidth - self.goal
-            distances.append(vec.magnitudeSquared())
-        index = distances.index(min(distances))
-        return directions[index]
+            step = self.directions[direction]
+            dx = node.x + step.x * twidth - goal.x
+            dy = node.y + step.y * twidth - goal.y
+            d = dx * dx + dy * dy
+            if bestd is None or d < bestd:
+                best, bestd = direction, d
+        return best
 
     def setStartNode(self, node):
         self.node = node
@@ -167,15 +191,59 @@ class Entity(object):
     def setSpeed(self, speed):
         self.speed = speed * twidth / 16
 
-    def render(self, screen):
+    def getState(self):
+        return (self.node.id, self.target.id, self.position.x, self.position.y, self.direction, self.speed,
+                self.visible)
+
+    def setState(self, state):
+        node, target, x, y, self.direction, self.speed, self.visible = state
+        nodes = self.node.graph.nodes
+        self.node, self.target = nodes[node], nodes[target]
+        self.position.set(x, y)
+
+    def savePosition(self):
+        self.prev = self.position.copy()
+
+    def getSweepStart(self, start):
+        if start is None:
+            return
+        dx, dy = self.position.x - start.x, self.position.y - start.y
+        if dx * dx + dy * dy > (2 * twidth) ** 2:
+            return
+        return start
+
+    def getBounds(self, start=None):
+        x0, y0, x1, y1 = self.position.x, self.position.y, self.position.x, self.position.y
+        if start is not None:
+            x0, y0, x1, y1 = min(x0, start.x), min(y0, start.y), max(x1, start.x), max(y1, start.y)
+        return x0 - self.colrad, y0 - self.colrad, x1 + self.colrad, y1 + self.colrad
+
+    def getRenderPosition(self, alpha=1.0):
+        if self.prev is None or alpha >= 1:
+            return self.position
+        d = self.position - self.prev
+        if d.magnitudeSquared() > (2 * twidth) ** 2:
+            return self.position
+        return self.prev + d * alpha
+
+    def render(self, screen, alpha=1.0):
         if self.visible:
+            position = self.getRenderPosition(alpha)
             if self.image is not None:
-                p = self.position - vec(twidth, theight) / 2
+                p = position - vec(twidth, theight) / 2
                 screen.blit(self.image, p.asTuple())
             else:
-                p = self.position.asInt()
+                p = position.asInt()
                 pygame.draw.circle(screen, self.color, p, self.rad)
 
+    def getRect(self, alpha=1.0):
+        position = self.getRenderPosition(alpha)
+        if self.image is not None:
+            p = position - vec(twidth, theight) / 2
+            return pygame.Rect(p.asInt(), self.image.get_size())
+        x, y = position.asInt()
+        return pygame.Rect(x - self.rad, y - self.rad, 2 * self.rad + 1, 2 * self.rad + 1)
+
 
 class Fruit(Entity):
     def __init__(self, node, level=0):
@@ -183,37 +251,71 @@ class Fruit(Entity):
         self.name = fru
         self.color = (0, 255, 0)
         self.lifespan = 10
-        self.timer = 0
         self.destroy = False
+        self.level = level
         self.points = 100 + level * 20
         self.setBetweenNodes(right)
-        self.sprites = FruitSprites(self, level)
 
-    def update(self, dt):
-        self.timer += dt
-        if self.timer >= self.lifespan:
-            self.destroy = True
+    def expire(self):
+        self.destroy = True
+
+    def getState(self, timers):
+        return self.level, self.points, self.destroy, timers.getTicksLeft(self)
+
+    def setState(self, state, timers):
+        self.level, self.points, self.destroy, ticks = state
+        if ticks is None:
+            timers.cancel(self)
+        else:
+            timers.setTimer(self, ticks, self.expire)
 
 
 class Ghost(Entity):
-    def __init__(self, node, pacman=None, blinky=None):
+    scatterGoal = (0, 0)
+    lead = 0
+
+    def __init__(self, node, pacman=None, blinky=None, mainmode=None):
         Entity.__init__(self, node)
         self.name = GHOST
         self.points = 200
         self.goal = vec()
         self.directionMethod = self.goalDirection
         self.pacman = pacman
-        self.mode = ModeController(self)
+        self.mode = ModeController(self, mainmode)
         self.blinky = blinky
         self.homeNode = node
+        self.paths = None
+        self.smart = False
 
     def reset(self):
         Entity.reset(self)
         self.points = 200
-        self.directionMethod = self.goalDirection
+        self.directionMethod = self.getGoalMethod()
+
+    def getGoalMethod(self):
+        if self.smart:
+            return self.smartDirection
+        return self.goalDirection
+
+    def spawnDirection(self, directions):
+        if self.paths is None:
+            return self.goalDirection(directions)
+        direction = self.paths.getDirection(self.node, self.spawnNode, directions)
+        if direction is None:
+            return self.goalDirection(directions)
+        return direction
+
+    def smartDirection(self, directions):
+        if self.paths is None or self.mode.cur is not CHASE:
+            return self.goalDirection(directions)
+        direction = self.paths.getDirection(self.node, self.paths.getNearest(self.goal), directions)
+        if direction is None:
+            return self.goalDirection(directions)
+        return direction
 
     def update(self, dt):
-        self.sprites.update(dt)
+        if self.sprites is not None:
+            self.sprites.update(dt)
         self.mode.update(dt)
         if self.mode.cur is SCATTER:
             self.scatter()
@@ -222,13 +324,18 @@ class Ghost(Entity):
         Entity.update(self, dt)
 
     def scatter(self):
-        self.goal = vec()
+        self.goal.set(self.scatterGoal[0] * twidth, self.scatterGoal[1] * theight)
 
     def chase(self):
-        self.goal = self.pacman.position
+        self.goal.set(self.pacman.position.x, self.pacman.position.y)
 
     def spawn(self):
-        self.goal = self.spawnNode.position
+        self.goal.set(self.spawnNode.position.x, self.spawnNode.position.y)
+
+    def setLeadGoal(self):
+        step = self.pacman.directions[self.pacman.direction]
+        self.goal.set(self.pacman.position.x + step.x * twidth * self.lead,
+                      self.pacman.position.y + step.y * twidth * self.lead)
 
     def setSpawnNode(self, node):
         self.spawnNode = node
@@ -237,7 +344,7 @@ class Ghost(Entity):
         self.mode.setSpawnMode()
         if self.mode.cur == SPAWN:
             self.setSpeed(150)
-            self.directionMethod = self.goalDirection
+            self.directionMethod = self.spawnDirection
             self.spawn()
 
     def startFreight(self):
@@ -248,74 +355,89 @@ class Ghost(Entity):
 
     def normalMode(self):
         self.setSpeed(100)
-        self.directionMethod = self.goalDirection
+        self.directionMethod = self.getGoalMethod()
         self.homeNode.denyAccess(down, self)
 
+    def getState(self):
+        return Entity.getState(self), self.goal.x, self.goal.y, self.points, self.mode.getState()
+
+    def setState(self, state):
+        entity, x, y, self.points, mode = state
+        Entity.setState(self, entity)
+        self.goal.set(x, y)
+        self.mode.setState(mode)
+        if self.mode.cur is FREIGHT:
+            self.directionMethod = self.randomDirection
+        elif self.mode.cur is SPAWN:
+            self.directionMethod = self.spawnDirection
+        else:
+            self.directionMethod = self.getGoalMethod()
+
 
 class Blinky(Ghost):
-    def __init__(self, node, pacman=None, blinky=None):
-        Ghost.__init__(self, node, pacman, blinky)
+    def __init__(self, node, pacman=None, blinky=None, mainmode=None):
+        Ghost.__init__(self, node, pacman, blinky, mainmode)
         self.name = bli
         self.color = (255, 0, 0)
-        self.sprites = GhostSprites(self)
 
 
 class Pinky(Ghost):
-    def __init__(self, node, pacman=None, blinky=None):
-        Ghost.__init__(self, node, pacman, blinky)
+    scatterGoal = (cols_, 0)
+    lead = 4
+
+    def __init__(self, node, pacman=None, blinky=None, mainmode=None):
+        Ghost.__init__(self, node, pacman, blinky, mainmode)
         self.name = pin
         self.color = (255, 100, 150)
-        self.sprites = GhostSprites(self)
-
-    def scatter(self):
-        self.goal = vec(twidth * cols_, 0)
 
     def chase(self):
-        self.goal = self.pacman.position + self.pacman.directions[self.pacman.direction] * twidth * 4
+        self.setLeadGoal()
 
 
 class Inky(Ghost):
-    def __init__(self, node, pacman=None, blinky=None):
-        Ghost.__init__(self, node, pacman, blinky)
+    scatterGoal = (cols_, rows_)
+    lead = 2
+
+    def __init__(self, node, pacman=None, blinky=None, mainmode=None):
+        Ghost.__init__(self, node, pacman, blinky, mainmode)
         self.name = ink
         self.color = (100, 255, 255)
-        self.sprites = GhostSprites(self)
-
-    def scatter(self):
-        self.goal = vec(twidth * cols_, theight * rows_)
 
     def chase(self):
-        vec1 = self.pacman.position + self.pacman.directions[self.pacman.direction] * twidth * 2
-        vec2 = (vec1 - self.blinky.position) * 2
-        self.goal = self.blinky.position + vec2
+        self.setLeadGoal()
+        blinky = self.blinky.position
+        self.goal.set(blinky.x + (self.goal.x - blinky.x) * 2, blinky.y + (self.goal.y - blinky.y) * 2)
 
 
 class Clyde(Ghost):
-    def __init__(self, node, pacman=None, blinky=None):
-        Ghost.__init__(self, node, pacman, blinky)
+    scatterGoal = (0, rows_)
+    lead = 4
+    shyness = 8
+
+    def __init__(self, node, pacman=None, blinky=None, mainmode=None):
+        Ghost.__init__(self, node, pacman, blinky, mainmode)
         self.name = cly
         self.color = (230, 190, 40)
-        self.sprites = GhostSprites(self)
-
-    def scatter(self):
-        self.goal = vec(0, theight * rows_)
 
     def chase(self):
-        d = self.pacman.position - self.position
-        ds = d.magnitudeSquared()
-        if ds <= (twidth * 8) ** 2:
+        dx, dy = self.pacman.position.x - self.position.x, self.pacman.position.y - self.position.y
+        if dx * dx + dy * dy <= (twidth * self.shyness) ** 2:
             self.scatter()
         else:
-            self.goal = self.pacman.position + self.pacman.directions[self.pacman.direction] * twidth * 4
+            self.setLeadGoal()
 
 
 class GhostGroup(object):
-    def __init__(self, node, pacman):
-        self.blinky = Blinky(node, pacman)
-        self.pinky = Pinky(node, pacman)
-        self.inky = Inky(node, pacman, self.blinky)
-        self.clyde = Clyde(node, pacman)
+    def __init__(self, node, pacman, rng=None):
+        self.mainmode = MainMode()
+        self.blinky = Blinky(node, pacman, mainmode=self.mainmode)
+        self.pinky = Pinky(node, pacman, mainmode=self.mainmode)
+        self.inky = Inky(node, pacman, self.blinky, self.mainmode)
+        self.clyde = Clyde(node, pacman, mainmode=self.mainmode)
         self.ghosts = [self.blinky, self.pinky, self.inky, self.clyde]
+        if rng is not None:
+            for ghost in self:
+                ghost.rng = rng
 
     def __iter__(self):
         return iter(self.ghosts)
@@ -323,6 +445,23 @@ class GhostGroup(object):
     def update(self, dt):
         [ghost.update(dt) for ghost in self]
 
+    def startTimers(self, timers):
+        self.mainmode.start(timers)
+        for ghost in self:
+            ghost.mode.timers = timers
+
+    def stopTimers(self):
+        self.mainmode.stop()
+        [ghost.mode.stop() for ghost in self]
+
+    def getState(self):
+        return self.mainmode.getState(), tuple([ghost.getState() for ghost in self])
+
+    def setState(self, state):
+        self.mainmode.setState(state[0])
+        for ghost, ghoststate in zip(self.ghosts, state[1]):
+            ghost.setState(ghoststate)
+
     def startFreight(self):
         [ghost.startFreight() for ghost in self]
         self.resetPoints()
@@ -349,8 +488,368 @@ class GhostGroup(object):
     def reset(self):
         [ghost.reset() for ghost in self]
 
-    def render(self, screen):
-        [ghost.render(screen) for ghost in self]
+    def savePositions(self):
+        [ghost.savePosition() for ghost in self]
+
+    def render(self, screen, alpha=1.0):
+        [ghost.render(screen, alpha) for ghost in self]
+
+    def getPersonalities(self):
+        return self.ghosts
+
+    def addColliders(self, colliders):
+        for ghost in self:
+            colliders.insert(ghost, ghost.prev)
+
+    def getCollisions(self, pacman, candidates=None):
+        if candidates is None:
+            candidates = self.ghosts
+        return [ghost for ghost in candidates if ghost.name != fru and pacman.collideGhost(ghost)]
+
+    def getRects(self, alpha=1.0):
+        return [ghost.getRect(alpha) for ghost in self]
+
+
+class HordeGhost(object):
+    __slots__ = ('horde', 'index')
+
+    def __init__(self, horde, index):
+        self.horde = horde
+        self.index = index
+
+    @property
+    def name(self):
+        return self.horde.getPersonality(self.index).name
+
+    @property
+    def colrad(self):
+        return self.horde.colrad
+
+    @property
+    def position(self):
+        return vec(*self.horde.position[self.index].tolist())
+
+    @property
+    def direction(self):
+        return GHOSTDIRS[self.horde.direction[self.index]]
+
+    @property
+    def mode(self):
+        return self
+
+    @property
+    def cur(self):
+        return int(self.horde.mode[self.index])
+
+    @property
+    def points(self):
+        return int(self.horde.points[self.index])
+
+    @property
+    def visible(self):
+        return bool(self.horde.visible[self.index])
+
+    @visible.setter
+    def visible(self, visible):
+        self.horde.visible[self.index] = visible
+
+    @property
+    def image(self):
+        return self.horde.getImage(self.index)
+
+    def getRect(self, alpha=1.0):
+        return self.horde.getRect(self.index, self.horde.getRenderPositions(alpha, self.index).tolist())
+
+    def startSpawn(self):
+        self.horde.startSpawn(self.index)
+
+
+class GhostHorde(object):
+    vectors = np.array([(0, -1), (0, 1), (-1, 0), (1, 0), (0, 0)], dtype=float)
+    reverse = np.array([1, 0, 3, 2, 4])
+
+    def __init__(self, node, pacman, rng=None, count=100, spread=4):
+        self.blinky = Blinky(node, pacman)
+        self.pinky = Pinky(node, pacman)
+        self.inky = Inky(node, pacman, self.blinky)
+        self.clyde = Clyde(node, pacman)
+        self.personalities = [self.blinky, self.pinky, self.inky, self.clyde]
+        self.pacman = pacman
+        self.count = count
+        self.spread = spread
+        self.seedrng = rng
+        self.rng = None
+        self.mainmode = MainMode()
+        self.timers = None
+        self.colrad = self.blinky.colrad
+        self.speeds = np.array([100, 100, 50, 150], dtype=float) * twidth / 16
+        self.graph = None
+
+    def __iter__(self):
+        if self.blinky.startNode.graph is not None:
+            self.build()
+        return iter([HordeGhost(self, i) for i in range(self.count)])
+
+    @property
+    def ghosts(self):
+        return list(self)
+
+    def getPersonalities(self):
+        return self.personalities
+
+    def getPersonality(self, index):
+        return self.personalities[index % 4]
+
+    def build(self):
+        if self.graph is not None:
+            return
+        self.graph = self.blinky.startNode.graph
+        self.rng = np.random.default_rng(None if self.seedrng is None else self.seedrng.getrandbits(64))
+        n = self.count
+        self.kind = np.arange(n) % 4
+        self.names = np.array([ghost.name for ghost in self.personalities])[self.kind]
+        self.squad = np.arange(n) // 4 * 4
+        self.starts = np.array([ghost.startNode.id for ghost in self.personalities])[self.kind]
+        self.spawnnode = self.blinky.spawnNode.id
+        self.scattergoals = np.array([(ghost.scatterGoal[0] * twidth, ghost.scatterGoal[1] * theight)
+                                      for ghost in self.personalities])[self.kind]
+        self.leads = np.array([ghost.lead for ghost in self.personalities], dtype=float)[self.kind]
+        self.shy = self.kind == self.personalities.index(self.clyde)
+        self.jitter = self.rng.uniform(-self.spread, self.spread, (n, 2)) * twidth
+        self.jitter[:4] = 0
+        self.mode = np.full(n, self.mainmode.mode)
+        self.goal = np.zeros((n, 2))
+        self.points = np.full(n, 200)
+        self.visible = np.ones(n, dtype=bool)
+        self.imagemode = np.full(n, -1)
+        self.imagedir = np.full(n, 4)
+        self.setPaths()
+        self.reset()
+
+    def setPaths(self):
+        nbr = np.maximum(self.graph.neighbors[:, :4], 0)
+        self.spawnhop = np.full((len(nbr), 4), -1, dtype=np.int64)
+        self.spawncost = np.full((4, len(nbr), 4), np.inf)
+        for k, ghost in enumerate(self.personalities):
+            if ghost.paths is not None:
+                dist = ghost.paths.dist
+                self.spawnhop[:, k] = ghost.paths.nexthop[:, self.spawnnode]
+                cost = dist[np.arange(len(nbr))[:, None], nbr] + dist[nbr, self.spawnnode]
+                self.spawncost[k] = np.where(self.graph.neighbors[:, :4] >= 0, cost, np.inf)
+
+    def reset(self):
+        self.build()
+        self.node = self.starts.copy()
+        self.target = self.starts.copy()
+        self.position = self.graph.position[self.node].copy()
+        self.prev = self.position.copy()
+        self.direction = np.full(self.count, 4)
+        self.visible[:] = True
+        self.points[:] = 200
+
+    def update(self, dt):
+        self.build()
+        self.updateImages()
+        self.updateModes(dt)
+        self.updateGoals()
+        self.move(dt)
+
+    def updateImages(self):
+        shown = (self.direction != 4) | (self.mode == FREIGHT)
+        self.imagemode[shown] = self.mode[shown]
+        self.imagedir[shown] = self.direction[shown]
+
+    def startTimers(self, timers):
+        self.timers = timers
+        self.mainmode.start(timers)
+
+    def stopTimers(self):
+        self.mainmode.stop()
+        if self.timers is not None:
+            self.timers.cancel(self)
+
+    def updateModes(self, dt):
+        mode = self.mode
+        normal = (mode == SCATTER) | (mode == CHASE) | ((mode == SPAWN) & (self.node == self.spawnnode))
+        mode[normal] = self.mainmode.mode
+
+    def endFreight(self):
+        self.mode[self.mode == FREIGHT] = self.mainmode.mode
+
+    def getState(self):
+        self.build()
+        arrays = [array.copy() for array in (self.node, self.target, self.position, self.direction, self.mode,
+                                             self.goal, self.points, self.visible, self.jitter)]
+        return (self.mainmode.getState(), self.timers.getTicksLeft(self), self.rng.bit_generator.state,
+                arrays)
+
+    def setState(self, state):
+        self.build()
+        mainmode, ticks, self.rng.bit_generator.state, arrays = state
+        self.mainmode.setState(mainmode)
+        if ticks is None:
+            self.timers.cancel(self)
+        else:
+            self.timers.setTimer(self, ticks, self.endFreight)
+        (self.node, self.target, self.position, self.direction, self.mode, self.goal, self.points,
+         self.visible, self.jitter) = [array.copy() for array in arrays]
+
+    def updateGoals(self):
+        pacman = self.pacman.position
+        step = self.pacman.directions[self.pacman.direction]
+        pac = np.array((pacman.x, pacman.y))
+        lead = pac + np.array((step.x, step.y)) * twidth * self.leads[:, None]
+        goal = lead
+        inky = self.kind == self.personalities.index(self.inky)
+        blinky = self.position[self.squad]
+        goal[inky] = blinky[inky] + (lead[inky] - blinky[inky]) * 2
+        d = ((pac - self.position) ** 2).sum(1)
+        shy = self.shy & (d <= (twidth * self.clyde.shyness) ** 2)
+        goal[shy] = self.scattergoals[shy]
+        goal += self.jitter
+        chase = self.mode == CHASE
+        self.goal[chase] = goal[chase]
+        scatter = self.mode == SCATTER
+        self.goal[scatter] = self.scattergoals[scatter] + self.jitter[scatter]
+        self.goal[self.mode == SPAWN] = self.graph.position[self.spawnnode]
+
+    def getValid(self, node, index):
+        access = (self.graph.access[node] >> self.names[index][:, None]) & 1
+        return (self.graph.neighbors[node, :4] >= 0) & access.astype(bool)
+
+    def move(self, dt):
+        position = self.position + self.vectors[self.direction] * (self.speeds[self.mode] * dt)[:, None]
+        nodepos = self.graph.position[self.node]
+        t = self.graph.position[self.target] - nodepos
+        p = position - nodepos
+        self.position = position
+        index = np.nonzero((p ** 2).sum(1) >= (t ** 2).sum(1))[0]
+        if len(index) == 0:
+            return
+        node, direction, mode = self.target[index], self.direction[index], self.mode[index]
+        rows = np.arange(len(index))
+        choices = self.getValid(node, index) & (np.arange(4) != self.reverse[direction][:, None])
+        ahead = self.graph.position[node][:, None, :] + self.vectors[:4] * twidth - self.goal[index][:, None, :]
+        choice = np.where(choices, -(ahead ** 2).sum(2), -np.inf).argmax(1)
+        rand = np.where(choices, self.rng.random(choices.shape), -1.0).argmax(1)
+        choice = np.where(mode == FREIGHT, rand, choice)
+        kind = self.kind[index]
+        hop = self.spawnhop[node, kind]
+        portal = self.graph.neighbors[node, 4]
+        hop = np.where(hop == 4, self.spawnhop[portal, kind], hop)
+        hopok = (hop >= 0) & (hop < 4) & choices[rows, np.clip(hop, 0, 3)]
+        cost = np.where(choices, self.spawncost[kind, node], np.inf)
+        spawn = (mode == SPAWN) & (hopok | np.isfinite(cost).any(1))
+        choice = np.where(spawn, np.where(hopok, hop, cost.argmin(1)), choice)
+        choice = np.where(choices.any(1), choice, self.reverse[direction])
+        node = np.where(portal >= 0, portal, node)
+        valid = self.getValid(node, index)
+        target = self.getTarget(node, choice, valid, rows)
+        moved = target != node
+        target = np.where(moved, target, self.getTarget(node, direction, valid, rows))
+        self.direction[index] = np.where(moved, choice, direction)
+        self.node[index] = node
+        self.target[index] = target
+        self.position[index] = self.graph.position[node]
+
+    def getTarget(self, node, direction, valid, rows):
+        ok = (direction < 4) & valid[rows, np.minimum(direction, 3)]
+        return np.where(ok, self.graph.neighbors[node, np.minimum(direction, 3)], node)
+
+    def startFreight(self):
+        self.build()
+        normal = (self.mode == SCATTER) | (self.mode == CHASE)
+        self.mode[normal] = FREIGHT
+        if self.timers is not None and (self.mode == FREIGHT).any():
+            self.timers.schedule(self, ModeController.freighttime, self.endFreight)
+        self.resetPoints()
+
+    def startSpawn(self, index):
+        if self.mode[index] == FREIGHT:
+            self.mode[index] = SPAWN
+
+    def setSpawnNode(self, node):
+        [ghost.setSpawnNode(node) for ghost in self.personalities]
+
+    def updatePoints(self):
+        self.points *= 2
+
+    def resetPoints(self):
+        self.points[:] = 200
+
+    def hide(self):
+        self.build()
+        self.visible[:] = False
+
+    def show(self):
+        self.build()
+        self.visible[:] = True
+
+    def savePositions(self):
+        self.build()
+        self.prev = self.position.copy()
+
+    def addColliders(self, colliders):
+        pass
+
+    def getCollisions(self, pacman, candidates=None):
+        self.build()
+        r = pacman.colrad + self.colrad
+        end = np.array(pacman.position.asTuple())
+        d = self.position - end
+        hit = (d ** 2).sum(1) <= r * r
+        start = pacman.getSweepStart(pacman.checked)
+        moved = ((self.position - self.prev) ** 2).sum(1) <= (2 * twidth) ** 2
+        gstart = np.where(moved[:, None], self.prev, self.position)
+        d0 = (end if start is None else np.array(start.asTuple())) - gstart
+        e = -d - d0
+        ee = (e ** 2).sum(1)
+        t = np.clip(-(d0 * e).sum(1) / np.where(ee > 0, ee, 1), 0, 1)
+        hit |= ((d0 + e * t[:, None]) ** 2).sum(1) <= r * r
+        return [HordeGhost(self, i) for i in np.nonzero(hit)[0].tolist()]
+
+    def getRenderPositions(self, alpha=1.0, index=slice(None)):
+        position = self.position[index]
+        if alpha >= 1:
+            return position
+        prev = self.prev[index]
+        d = position - prev
+        jump = (d ** 2).sum(-1) > (2 * twidth) ** 2
+        return np.where(jump[..., None], position, prev + d * alpha)
+
+    def getRect(self, index, position):
+        x, y = position
+        image = self.getImage(index)
+        if image is not None:
+            return pygame.Rect((int(x - twidth / 2), int(y - theight / 2)), image.get_size())
+        rad = self.getPersonality(index).rad
+        return pygame.Rect(int(x) - rad, int(y) - rad, 2 * rad + 1, 2 * rad + 1)
+
+    def getRects(self, alpha=1.0):
+        self.build()
+        return [self.getRect(i, position) for i, position in enumerate(self.getRenderPositions(alpha).tolist())]
+
+    def getImage(self, index):
+        ghost = self.getPersonality(index)
+        if ghost.sprites is None:
+            return
+        if self.imagemode[index] < 0:
+            return ghost.sprites.getStartImage()
+        return ghost.sprites.table[int(self.imagemode[index])][GHOSTDIRS[self.imagedir[index]]]
+
+    def render(self, screen, alpha=1.0):
+        self.build()
+        positions = (self.getRenderPositions(alpha) - (twidth / 2, theight / 2)).tolist()
+        items = []
+        for i in np.nonzero(self.visible)[0].tolist():
+            image = self.getImage(i)
+            if image is not None:
+                items.append((image, positions[i]))
+            else:
+                ghost = self.getPersonality(i)
+                pygame.draw.circle(screen, ghost.color, (int(positions[i][0] + twidth / 2),
+                                                         int(positions[i][1] + theight / 2)), ghost.rad)
+        screen.blits(items, False)
 
 
 def checkEv(self):
@@ -420,91 +919,248 @@ class Maze2(MazeBase):
                               right: (self.addOffset(2, 3),)}
 
 
+class LevelData(object):
+    magic = b'PYMANLVL'
+    version = 1
+    fields = ('tiles', 'rotation', 'nodes', 'neighbors', 'portals', 'pellets', 'walls', 'doors')
+
+    def __init__(self, name, arrays, source=None):
+        self.name = name
+        self.source = source
+        for field in LevelData.fields:
+            setattr(self, field, arrays[field])
+
+    @classmethod
+    def load(cls, maze, mmap=False):
+        path = 'levels/' + maze.name
+        source = cls.getSource(maze)
+        arrays = cls.read(path + '.lvl', source, mmap)
+        if arrays is None:
+            arrays = cls.compile(maze)
+            cls.write(path + '.lvl', source, arrays)
+        return cls(maze.name, arrays, source)
+
+    @classmethod
+    def getSource(cls, maze):
+        digest = hashlib.sha1(str((cls.version, sorted(maze.portalPairs.values()))).encode())
+        for suffix in ('.txt', '_rotation.txt'):
+            with open('levels/' + maze.name + suffix, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    @classmethod
+    def read(cls, path, source, mmap=False):
+        try:
+            if mmap:
+                buf = np.memmap(path, dtype=np.uint8, mode='r')
+            else:
+                buf = np.fromfile(path, dtype=np.uint8)
+        except (OSError, ValueError):
+            return
+        try:
+            if buf[:8].tobytes() != cls.magic:
+                return
+            size = struct.unpack_from('<I', buf, 8)[0]
+            if 12 + size > len(buf):
+                return
+            header = json.loads(buf[12:12 + size].tobytes().decode())
+            if header['source'] != source:
+                return
+            arrays = {}
+            for name, dtype, shape, offset in header['arrays']:
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape)) * dtype.itemsize
+                if offset < 0 or offset + count > len(buf):
+                    return
+                arrays[name] = buf[offset:offset + count].view(dtype).reshape(shape)
+        except (ValueError, KeyError, TypeError, struct.error):
+            return
+        if any(name not in arrays for name in cls.fields):
+            return
+        return arrays
+
+    @classmethod
+    def write(cls, path, source, arrays):
+        entries = []
+        offset = 0
+        for name in cls.fields:
+            array = np.ascontiguousarray(arrays[name])
+            entries.append([name, array.dtype.str, list(array.shape), offset])
+            offset += -(-array.nbytes // 8) * 8
+        header = {'version': cls.version, 'source': source, 'arrays': entries}
+        size = len(json.dumps(header)) + 32
+        start = -(-(12 + size) // 8) * 8
+        for entry in entries:
+            entry[3] += start
+        data = json.dumps(header).encode().ljust(start - 12)
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path) or '.',
+                                             prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False) as f:
+                tmp = f.name
+                f.write(cls.magic + np.uint32(len(data)).tobytes() + data)
+                for name, dtype, shape, offset in entries:
+                    f.seek(offset)
+                    f.write(np.ascontiguousarray(arrays[name]).tobytes())
+            os.replace(tmp, path)
+        except OSError:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    @classmethod
+    def compile(cls, maze):
+        data = np.loadtxt('levels/' + maze.name + '.txt', dtype='<U1')
+        rotdata = np.loadtxt('levels/' + maze.name + '_rotation.txt', dtype='<U1')
+        nodes = NodeG()
+        nodes.createNodeTable(data)
+        nodes.connectHorizontally(data)
+        nodes.connectVertically(data)
+        nodelist = nodes.indexNodes()
+        arrays = {'tiles': data.view(np.uint32).astype(np.uint8),
+                  'rotation': np.where(np.char.isdigit(rotdata), rotdata, '-1').astype(np.int8),
+                  'nodes': np.array([(node.position.x // twidth, node.position.y // theight) for node in nodelist],
+                                    dtype=np.int32).reshape(-1, 2),
+                  'neighbors': np.array([[-1 if node.neighbors[d] is None else node.neighbors[d].id
+                                          for d in (up, down, left, right)] for node in nodelist],
+                                        dtype=np.int32).reshape(-1, 4)}
+        portals = []
+        for pair1, pair2 in maze.portalPairs.values():
+            node1, node2 = nodes.getNodeFromTiles(*pair1), nodes.getNodeFromTiles(*pair2)
+            if node1 is not None and node2 is not None:
+                portals.append((node1.id, node2.id))
+        arrays['portals'] = np.array(portals, dtype=np.int32).reshape(-1, 2)
+        pellets, walls, doors = [], [], []
+        for i in range(data.shape[0]):
+            for j in range(data.shape[1]):
+                if data[i][j] in ['.', '+']:
+                    pellets.append((i, j, PELLET))
+                elif data[i][j] in ['P', 'p']:
+                    pellets.append((i, j, POWERPELLET))
+                if data[i][j].isdigit():
+                    walls.append((i, j, int(data[i][j]) + 12, int(rotdata[i][j])))
+                elif data[i][j] == '=':
+                    doors.append((i, j))
+        arrays['pellets'] = np.array(pellets, dtype=np.int16).reshape(-1, 3)
+        arrays['walls'] = np.array(walls, dtype=np.int16).reshape(-1, 4)
+        arrays['doors'] = np.array(doors, dtype=np.int16).reshape(-1, 2)
+        return arrays
+
+
 class MainMode(object):
     def __init__(self):
-        self.timer = 0
+        self.timers = None
         self.scatter()
 
-    def update(self, dt):
-        self.timer += dt
-        if self.timer >= self.time:
-            if self.mode is SCATTER:
-                self.chase()
-            elif self.mode is CHASE:
-                self.scatter()
+    def start(self, timers):
+        self.timers = timers
+        self.timers.schedule(self, self.time, self.switch)
+
+    def stop(self):
+        if self.timers is not None:
+            self.timers.cancel(self)
+
+    def switch(self):
+        if self.mode is SCATTER:
+            self.chase()
+        elif self.mode is CHASE:
+            self.scatter()
+        self.timers.schedule(self, self.time, self.switch)
 
     def scatter(self):
         self.mode = SCATTER
         self.time = 7
-        self.timer = 0
 
     def chase(self):
         self.mode = CHASE
         self.time = 20
-        self.timer = 0
+
+    def getState(self):
+        return self.mode, self.time, self.timers.getTicksLeft(self)
+
+    def setState(self, state):
+        self.mode, self.time, ticks = state
+        if ticks is None:
+            self.timers.cancel(self)
+        else:
+            self.timers.setTimer(self, ticks, self.switch)
 
 
 class ModeController(object):
-    def __init__(self, entity):
-        self.timer = 0
+    freighttime = 7
+
+    def __init__(self, entity, mainmode=None):
         self.time = None
-        self.mainmode = MainMode()
+        self.timers = None
+        self.mainmode = MainMode() if mainmode is None else mainmode
         self.cur = self.mainmode.mode
         self.entity = entity
 
     def update(self, dt):
-        self.mainmode.update(dt)
-        if self.cur is FREIGHT:
-            self.timer += dt
-            if self.timer >= self.time:
-                self.time = None
-                self.entity.normalMode()
-                self.cur = self.mainmode.mode
-        elif self.cur in [SCATTER, CHASE]:
+        if self.cur in [SCATTER, CHASE]:
             self.cur = self.mainmode.mode
         if self.cur is SPAWN:
             if self.entity.node == self.entity.spawnNode:
                 self.entity.normalMode()
                 self.cur = self.mainmode.mode
 
+    def stop(self):
+        if self.timers is not None:
+            self.timers.cancel(self)
+
+    def endFreight(self):
+        self.time = None
+        self.entity.normalMode()
+        self.cur = self.mainmode.mode
+
     def setFreightMode(self):
-        if self.cur in [SCATTER, CHASE]:
-            self.timer = 0
-            self.time = 7
+        if self.cur in [SCATTER, CHASE, FREIGHT]:
+            self.time = self.freighttime
             self.cur = FREIGHT
-        elif self.cur is FREIGHT:
-            self.timer = 0
+            if self.timers is not None:
+                self.timers.schedule(self, self.time, self.endFreight)
 
     def setSpawnMode(self):
         if self.cur is FREIGHT:
+            self.time = None
+            self.stop()
             self.cur = SPAWN
 
+    def getState(self):
+        return self.cur, self.time, self.timers.getTicksLeft(self)
+
+    def setState(self, state):
+        self.cur, self.time, ticks = state
+        if ticks is None:
+            self.timers.cancel(self)
+        else:
+            self.timers.setTimer(self, ticks, self.endFreight)
+
 
 class MazeData(object):
-    def __init__(self):
+    mazes = {'maze1': Maze1, 'maze2': Maze2}
+
+    def __init__(self, names=None):
         self.obj = None
-        self.mazedict = {0: Maze1, 1: Maze2}
+        self.names = ['maze1', 'maze2'] if names is None else list(names)
+        self.mazedict = dict(enumerate(MazeData.mazes[name] for name in self.names))
 
-    def loadMaze(self, level):
-        self.obj = self.mazedict[level % len(self.mazedict)]()
+    def getMaze(self, level):
+        return self.mazedict[level % len(self.mazedict)]()
 
 
 class Node(object):
     def __init__(self, x, y):
+        self.id = None
+        self.graph = None
         self.position = vec(x, y)
-        self.neighbors = {up: None, down: None, left: None, right: None, port: None}
-        self.access = {up: [PACMAN, bli, pin, ink, cly, fru],
-                       down: [PACMAN, bli, pin, ink, cly, fru],
-                       left: [PACMAN, bli, pin, ink, cly, fru],
-                       right: [PACMAN, bli, pin, ink, cly, fru]}
+        self.neighbors = {stop: None, up: None, down: None, left: None, right: None, port: None}
+        self.access = [ALLACCESS] * 4
 
     def denyAccess(self, direction, entity):
-        if entity.name in self.access[direction]:
-            self.access[direction].remove(entity.name)
+        self.access[ACCESSSLOTS[direction]] &= ~(1 << entity.name)
 
     def allowAccess(self, direction, entity):
-        if entity.name not in self.access[direction]:
-            self.access[direction].append(entity.name)
+        self.access[ACCESSSLOTS[direction]] |= 1 << entity.name
 
     def render(self, screen):
         for n in self.neighbors.keys():
@@ -515,20 +1171,107 @@ class Node(object):
                 pygame.draw.circle(screen, (255, 0, 0), self.position.asInt(), 12)
 
 
+class ArrayGraph(object):
+    def __init__(self, nodes):
+        self.nodes = nodes.indexNodes()
+        n = len(self.nodes)
+        self.position = np.zeros((n, 2))
+        self.neighbors = np.full((n, len(GRAPHDIRS)), -1, dtype=np.int32)
+        self.access = np.zeros((n, 4), dtype=np.int32)
+        for node in self.nodes:
+            node.graph = self
+            self.position[node.id] = node.position.asTuple()
+            for i in range(len(GRAPHDIRS)):
+                neighbor = node.neighbors[GRAPHDIRS[i]]
+                if neighbor is not None:
+                    self.neighbors[node.id, i] = neighbor.id
+            self.access[node.id] = node.access
+            node.access = memoryview(self.access[node.id])
+
+    def getNode(self, id):
+        return self.nodes[id]
+
+
+class PathTable(object):
+    def __init__(self, graph, name, extra=()):
+        n = len(graph.nodes)
+        self.position = graph.position
+        access = ((graph.access >> name) & 1).astype(bool)
+        for id, slot in extra:
+            access[id, slot] = True
+        dist = np.full((n, n), np.inf)
+        nexthop = np.full((n, n), -1, dtype=np.int8)
+        for slot in range(len(GRAPHDIRS)):
+            ids = np.nonzero(graph.neighbors[:, slot] >= 0)[0]
+            if GRAPHDIRS[slot] != port:
+                ids = ids[access[ids, slot]]
+            others = graph.neighbors[ids, slot]
+            weight = np.zeros(len(ids))
+            if GRAPHDIRS[slot] != port:
+                weight = np.abs(self.position[others] - self.position[ids]).sum(1)
+            dist[ids, others] = weight
+            nexthop[ids, others] = slot
+        np.fill_diagonal(dist, 0)
+        for k in range(n):
+            via = dist[:, k, None] + dist[None, k, :]
+            better = via < dist
+            dist = np.where(better, via, dist)
+            nexthop = np.where(better, nexthop[:, k, None], nexthop)
+        self.dist = dist
+        self.nexthop = nexthop
+        ys, xs = np.mgrid[0:rows_, 0:cols_]
+        d = (xs[..., None] * twidth - self.position[:, 0]) ** 2 + (ys[..., None] * theight - self.position[:, 1]) ** 2
+        self.nearest = d.argmin(2)
+
+    def getNearest(self, position):
+        col = min(max(int(position.x) // twidth, 0), cols_ - 1)
+        row = min(max(int(position.y) // theight, 0), rows_ - 1)
+        return int(self.nearest[row, col])
+
+    def getDirection(self, node, goal, directions):
+        goal = goal if isinstance(goal, int) else goal.id
+        slot = self.nexthop[node.id, goal]
+        if slot >= 0 and GRAPHDIRS[slot] == port:
+            slot = self.nexthop[node.neighbors[port].id, goal]
+        if slot >= 0 and GRAPHDIRS[slot] in directions:
+            return GRAPHDIRS[slot]
+        best, bestd = None, np.inf
+        for direction in directions:
+            neighbor = node.neighbors[direction]
+            if neighbor is not None:
+                d = self.dist[node.id, neighbor.id] + self.dist[neighbor.id, goal]
+                if d < bestd:
+                    best, bestd = direction, d
+        return best
+
+
 class NodeG(object):
-    def __init__(self, level):
-        self.level = level
+    pathcache = {}
+
+    def __init__(self, level=None):
+        self.level = None
         self.nodesLUT = {}
         self.nodeSymbols = ['+', 'P', 'n']
         self.pathSymbols = ['.', '-', '|', 'p']
-        data = self.readmz(level)
-        self.createNodeTable(data)
-        self.connectHorizontally(data)
-        self.connectVertically(data)
         self.homekey = None
-
-    def readmz(self, textfile):
-        return np.loadtxt(textfile, dtype='<U1')
+        self.graph = None
+        if level is not None:
+            self.level = level.name
+            self.loadNodes(level)
+
+    def loadNodes(self, level):
+        nodes = []
+        for col, row in level.nodes.tolist():
+            key = self.constructKey(col, row)
+            self.nodesLUT[key] = Node(*key)
+            nodes.append(self.nodesLUT[key])
+        for i, ids in enumerate(level.neighbors.tolist()):
+            for direction, id in zip((up, down, left, right), ids):
+                if id >= 0:
+                    nodes[i].neighbors[direction] = nodes[id]
+        for id1, id2 in level.portals.tolist():
+            nodes[id1].neighbors[port] = nodes[id2]
+            nodes[id2].neighbors[port] = nodes[id1]
 
     def createNodeTable(self, data, xoffset=0, yoffset=0):
         for row in list(range(data.shape[0])):
@@ -574,6 +1317,32 @@ class NodeG(object):
     def getStartTempNode(self):
         return list(self.nodesLUT.values())[0]
 
+    def indexNodes(self):
+        nodes = list(self.nodesLUT.values())
+        for i in range(len(nodes)):
+            nodes[i].id = i
+        return nodes
+
+    def toArrays(self):
+        self.graph = ArrayGraph(self)
+        return self.graph
+
+    def getAccess(self):
+        return self.graph.access.copy()
+
+    def setAccess(self, access):
+        np.copyto(self.graph.access, access)
+
+    def getPaths(self, name, extra=()):
+        if self.graph is None:
+            self.toArrays()
+        key = (self.level, name)
+        with CACHELOCK:
+            if key not in NodeG.pathcache:
+                extra = [(node.id, GRAPHDIRS.index(direction)) for node, direction in extra]
+                NodeG.pathcache[key] = PathTable(self.graph, name, extra)
+            return NodeG.pathcache[key]
+
     def setPortalPair(self, pair1, pair2):
         key1 = self.constructKey(*pair1)
         key2 = self.constructKey(*pair2)
@@ -651,23 +1420,41 @@ class Pacman(Entity):
         self.direction = left
         self.setBetweenNodes(left)
         self.alive = True
-        self.sprites = PacmanSprites(self)
+        self.key = stop
+        self.checked = None
 
     def reset(self):
         Entity.reset(self)
         self.direction = left
         self.setBetweenNodes(left)
         self.alive = True
-        self.image = self.sprites.getStartImage()
-        self.sprites.reset()
+        self.checked = None
+        if self.sprites is not None:
+            self.image = self.sprites.getStartImage()
+            self.sprites.reset()
 
     def die(self):
         self.alive = False
         self.direction = stop
 
+    def getState(self):
+        checked = None if self.checked is None else self.checked.asTuple()
+        return Entity.getState(self), self.alive, self.key, checked
+
+    def setState(self, state):
+        entity, self.alive, self.key, checked = state
+        Entity.setState(self, entity)
+        if checked is None:
+            self.checked = None
+        elif self.checked is None:
+            self.checked = vec(*checked)
+        else:
+            self.checked.set(*checked)
+
     def update(self, dt):
-        self.sprites.update(dt)
-        self.position += self.directions[self.direction] * self.speed * dt
+        if self.sprites is not None:
+            self.sprites.update(dt)
+        self.position.addScaled(self.directions[self.direction], self.speed * dt)
         direction = self.getValidKey()
         if self.overshotTarget():
             self.node = self.target
@@ -687,6 +1474,99 @@ class Pacman(Entity):
                 self.reverseDirection()
 
     def getValidKey(self):
+        return self.key
+
+    def eatPellets(self, pellets):
+        return pellets.getPellets(self.position, self.colrad, self.getSweepStart(self.checked))
+
+    def collideGhost(self, ghost):
+        return self.collideCheck(ghost, self.getSweepStart(self.checked), ghost.getSweepStart(ghost.prev))
+
+    def collideCheck(self, other, start=None, otherstart=None):
+        dx, dy = self.position.x - other.position.x, self.position.y - other.position.y
+        r = self.colrad + other.colrad
+        if dx * dx + dy * dy <= r * r:
+            return True
+        if start is None and otherstart is None:
+            return False
+        start = start or self.position
+        otherstart = otherstart or other.position
+        return SpatialHash.sweep(start.x, start.y, self.position.x, self.position.y,
+                                 otherstart.x, otherstart.y, other.position.x, other.position.y) <= r * r
+
+    def setChecked(self):
+        if self.checked is None:
+            self.checked = self.position.copy()
+        else:
+            self.checked.set(self.position.x, self.position.y)
+
+
+class SpatialHash(object):
+    def __init__(self, cellsize=2 * twidth, minitems=8):
+        self.cellsize = cellsize
+        self.minitems = minitems
+        self.items = []
+        self.cells = None
+
+    def clear(self):
+        self.items = []
+        self.cells = None
+
+    def insert(self, entity, start=None):
+        self.items.append((entity, start))
+
+    def getKeys(self, bounds):
+        size = self.cellsize
+        cols = range(int(bounds[0] // size), int(bounds[2] // size) + 1)
+        return [(col, row) for row in range(int(bounds[1] // size), int(bounds[3] // size) + 1) for col in cols]
+
+    def build(self):
+        self.cells = {}
+        for index, (entity, start) in enumerate(self.items):
+            item = (index, entity)
+            for key in self.getKeys(entity.getBounds(entity.getSweepStart(start))):
+                cell = self.cells.get(key)
+                if cell is None:
+                    self.cells[key] = [item]
+                else:
+                    cell.append(item)
+
+    def query(self, entity, start=None):
+        if len(self.items) < self.minitems:
+            return [item[0] for item in self.items]
+        if self.cells is None:
+            self.build()
+        found = []
+        for key in self.getKeys(entity.getBounds(entity.getSweepStart(start))):
+            found.extend(self.cells.get(key, ()))
+        if len(found) > 1:
+            found = sorted(dict(found).items())
+        return [item[1] for item in found]
+
+    @staticmethod
+    def sweep(ax0, ay0, ax1, ay1, bx0, by0, bx1, by1):
+        dx, dy = ax0 - bx0, ay0 - by0
+        ex, ey = ax1 - bx1 - dx, ay1 - by1 - dy
+        ee = ex * ex + ey * ey
+        t = 0
+        if ee > 0:
+            t = min(max(-(dx * ex + dy * ey) / ee, 0), 1)
+        x, y = dx + ex * t, dy + ey * t
+        return x * x + y * y
+
+
+class InputSource(object):
+    locked = False
+
+    def getKey(self, game):
+        return stop
+
+    def update(self, game):
+        return
+
+
+class KeyboardInput(InputSource):
+    def getKey(self, game):
         key_pressed = pygame.key.get_pressed()
         if key_pressed[pygame.K_UP] or key_pressed[pygame.K_w]:
             return up
@@ -698,52 +1578,323 @@ class Pacman(Entity):
             return right
         return stop
 
-    def eatPellets(self, pellist):
-        for pellet in pellist:
-            if self.collideCheck(pellet):
-                return pellet
-        return
 
-    def collideGhost(self, ghost):
-        return self.collideCheck(ghost)
+class ActionInput(InputSource):
+    def __init__(self, key=stop):
+        self.key = key
+
+    def getKey(self, game):
+        return self.key
+
+
+class Replay(object):
+    magic = b'PYMANREP'
+    version = 1
+    keys = (stop, up, down, left, right)
+    PAUSE, FAST, CHECK, END = 5, 6, 7, 8
+    interval = 300
+
+    @staticmethod
+    def encode(value):
+        data = bytearray()
+        while value >= 0x80:
+            data.append(value & 0x7f | 0x80)
+            value >>= 7
+        data.append(value)
+        return bytes(data)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            buf = f.read()
+        if buf[:8] != cls.magic:
+            raise ValueError('%s is not a replay file' % path)
+        size = int.from_bytes(buf[8:12], 'little')
+        header = json.loads(buf[12:12 + size].decode())
+        if header.get('version') != cls.version:
+            raise ValueError('%s has replay version %s, expected %d' % (path, header.get('version'), cls.version))
+        events = []
+        frame, i = header['frame'], 12 + size
+        try:
+            while i < len(buf):
+                delta, shift = 0, 0
+                while buf[i] & 0x80:
+                    delta |= (buf[i] & 0x7f) << shift
+                    shift += 7
+                    i += 1
+                delta |= buf[i] << shift
+                code = buf[i + 1]
+                i += 2
+                value = None
+                if code == cls.CHECK:
+                    if i + 4 > len(buf):
+                        break
+                    value = int.from_bytes(buf[i:i + 4], 'little')
+                    i += 4
+                frame += delta
+                events.append((frame, code, value))
+        except IndexError:
+            pass
+        return header, events
+
+
+class ReplayRecorder(object):
+    def __init__(self, path, game, interval=Replay.interval):
+        self.file = open(path, 'wb', buffering=1 << 16)
+        self.interval = interval
+        self.frame = game.frame
+        self.key = stop
+        header = json.dumps({'version': Replay.version, 'seed': game.seed, 'hz': game.hz, 'autostart': game.autostart,
+                             'fastforward': game.fastforward, 'smart': game.smart, 'horde': game.horde,
+                             'mazes': game.mzdata.names, 'level': game.level, 'frame': game.frame,
+                             'interval': interval}).encode()
+        self.file.write(Replay.magic + len(header).to_bytes(4, 'little') + header)
+
+    def addEvent(self, frame, code, data=b''):
+        if frame < self.frame:
+            raise ValueError('replay event at frame %d comes after frame %d' % (frame, self.frame))
+        self.file.write(Replay.encode(frame - self.frame) + bytes((code,)) + data)
+        self.frame = frame
+
+    def setKey(self, frame, key):
+        if key != self.key:
+            self.key = key
+            self.addEvent(frame, Replay.keys.index(key))
+
+    def update(self, game):
+        if game.frame % self.interval == 0:
+            self.addEvent(game.frame, Replay.CHECK, game.getChecksum().to_bytes(4, 'little'))
+            self.file.flush()
+
+    def close(self, game):
+        self.addEvent(game.frame, Replay.END)
+        self.file.close()
+
+
+class ReplayInput(InputSource):
+    locked = True
+
+    def __init__(self, path):
+        self.header, self.events = Replay.read(path)
+        self.index = 0
+        self.key = stop
+        self.checked = 0
+        self.mismatches = []
+
+    def getOptions(self):
+        return {name: self.header[name] for name in ('seed', 'hz', 'autostart', 'fastforward', 'smart', 'horde',
+                                                     'mazes')}
+
+    def getKey(self, game):
+        events = self.events
+        while self.index < len(events) and events[self.index][0] <= game.frame and events[self.index][1] < 5:
+            self.key = Replay.keys[events[self.index][1]]
+            self.index += 1
+        return self.key
+
+    def update(self, game):
+        events = self.events
+        while self.index < len(events) and events[self.index][0] <= game.frame:
+            frame, code, value = events[self.index]
+            self.index += 1
+            if code < 5:
+                self.key = Replay.keys[code]
+            elif code == Replay.PAUSE:
+                game.togglePause()
+            elif code == Replay.FAST:
+                game.setFastForward(not game.fastforward)
+            elif code == Replay.CHECK:
+                if game.getChecksum() == value:
+                    self.checked += 1
+                else:
+                    self.mismatches.append(frame)
+
+    def isDone(self, game):
+        self.update(game)
+        return self.index >= len(self.events)
+
+
+class Scheduler(object):
+    def __init__(self, dt):
+        self.dt = dt
+        self.tick = 0
+        self.heap = []
+        self.timers = {}
+        self.count = 0
+        self.dead = 0
+        self.ticks = {}
+
+    def getTicks(self, time):
+        ticks = self.ticks.get(time)
+        if ticks is None:
+            elapsed, ticks = self.dt, 1
+            while elapsed < time:
+                elapsed += self.dt
+                ticks += 1
+            self.ticks[time] = ticks
+        return ticks
+
+    def schedule(self, key, time, func):
+        self.setTimer(key, self.getTicks(time), func)
+
+    def setTimer(self, key, ticks, func):
+        self.cancel(key)
+        self.count += 1
+        timer = [self.tick + ticks, self.count, key, func]
+        self.timers[key] = timer
+        heapq.heappush(self.heap, timer)
+
+    def getTicksLeft(self, key):
+        timer = self.timers.get(key)
+        if timer is not None:
+            return timer[0] - self.tick
+
+    def cancel(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer[3] = None
+            self.dead += 1
+            if self.dead > 64 and self.dead > len(self.timers):
+                self.heap = [item for item in self.heap if item[3] is not None]
+                heapq.heapify(self.heap)
+                self.dead = 0
+
+    def update(self):
+        self.tick += 1
+        heap = self.heap
+        while heap and heap[0][0] <= self.tick:
+            tick, count, key, func = heapq.heappop(heap)
+            if func is None:
+                self.dead -= 1
+            else:
+                del self.timers[key]
+                func()
 
-    def collideCheck(self, other):
-        d = self.position - other.position
-        dSquared = d.magnitudeSquared()
-        rSquared = (self.colrad + other.colrad) ** 2
-        return dSquared <= rSquared
+    def clear(self):
+        self.heap = []
+        self.timers = {}
+        self.dead = 0
 
 
 class Pause(object):
-    def __init__(self, paused=False):
+    def __init__(self, timers, paused=False):
+        self.timers = timers
         self.paused = paused
-        self.timer = 0
         self.pauseTime = None
         self.func = None
 
-    def update(self, dt):
-        if self.pauseTime is not None:
-            self.timer += dt
-            if self.timer >= self.pauseTime:
-                self.timer = 0
-                self.paused = False
-                self.pauseTime = None
-                return self.func
-        return
+    def expire(self):
+        self.paused = False
+        self.pauseTime = None
+        if self.func is not None:
+            self.func()
 
     def setPause(self, playerPaused=False, pauseTime=None, func=None):
-        self.timer = 0
         self.func = func
         self.pauseTime = pauseTime
+        if pauseTime is None:
+            self.timers.cancel(self)
+        else:
+            self.timers.schedule(self, pauseTime, self.expire)
         self.flip()
 
     def flip(self):
         self.paused = not self.paused
 
+    def getState(self):
+        return self.paused, self.pauseTime, self.func, self.timers.getTicksLeft(self)
+
+    def setState(self, state):
+        self.paused, self.pauseTime, self.func, ticks = state
+        if ticks is None:
+            self.timers.cancel(self)
+        else:
+            self.timers.setTimer(self, ticks, self.expire)
+
+
+class FrameProfiler(object):
+    stages = ('wait', 'input', 'ghosts', 'colliders', 'PellE', 'ghostE', 'fruitE', 'pacman', 'timers', 'events',
+              'render', 'total')
+    WAIT, INPUT, GHOSTS, COLLIDERS, PELLETS, GHOSTE, FRUITE, PACMAN, TIMERS, EVENTS, RENDER, TOTAL = range(12)
+
+    def __init__(self, size=1024, refresh=30, visible=True):
+        self.size = size
+        self.refresh = refresh
+        self.visible = visible
+        self.times = np.zeros((size, len(self.stages)))
+        self.zeros = [0.0] * len(self.stages)
+        self.cur = list(self.zeros)
+        self.count = 0
+        self.start = 0.0
+        self.last = 0.0
+        self.position = (0, 2 * theight)
+        self.overlay = None
+        self.drawn = 0
+
+    def begin(self):
+        self.cur[:] = self.zeros
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        t = time.perf_counter()
+        self.cur[stage] += t - self.last
+        self.last = t
+
+    def end(self):
+        self.cur[self.TOTAL] = time.perf_counter() - self.start - self.cur[self.WAIT]
+        self.times[self.count % self.size] = self.cur
+        self.count += 1
+
+    def getSamples(self):
+        if self.count <= self.size:
+            return self.times[:self.count]
+        i = self.count % self.size
+        return np.concatenate((self.times[i:], self.times[:i]))
+
+    def getSummary(self):
+        samples = self.getSamples() * 1000
+        if len(samples) == 0:
+            return {}
+        p50, p99 = np.percentile(samples, (50, 99), axis=0)
+        return {stage: {'p50': round(p50[i], 4), 'p99': round(p99[i], 4), 'mean': round(samples[:, i].mean(), 4),
+                        'max': round(samples[:, i].max(), 4)} for i, stage in enumerate(self.stages)}
+
+    def getLines(self):
+        summary = self.getSummary()
+        lines = ['%-9s %7s %7s' % ('ms', 'p50', 'p99')]
+        for stage in self.stages[1:]:
+            if stage in summary:
+                lines.append('%-9s %7.3f %7.3f' % (stage, summary[stage]['p50'], summary[stage]['p99']))
+        return lines
+
+    def getOverlay(self):
+        if self.overlay is None or self.count - self.drawn >= self.refresh:
+            atlas = GlyphAtlas.get('fonts/PressStart2P-Regular.ttf', 8, (0, 255, 0))
+            labels = [atlas.compose(line) for line in self.getLines()]
+            height = atlas.height + 2
+            self.overlay = pygame.Surface((max(label.get_width() for label in labels) + 4, len(labels) * height + 2))
+            for i in range(len(labels)):
+                self.overlay.blit(labels[i], (2, 2 + i * height))
+            self.drawn = self.count
+        return self.overlay
+
+    def export(self, path):
+        samples = self.getSamples() * 1000
+        first = self.count - len(samples)
+        with open(path, 'w', newline='') as out:
+            if path.endswith('.json'):
+                json.dump({'frames': self.count, 'stages': list(self.stages), 'summary': self.getSummary(),
+                           'samples': samples.round(4).tolist()}, out)
+            else:
+                writer = csv.writer(out)
+                writer.writerow(('frame',) + self.stages)
+                writer.writerows([first + i] + row for i, row in enumerate(samples.round(4).tolist()))
+
 
 class Pellet(object):
     def __init__(self, row, column):
         self.name = PELLET
+        self.row, self.col = row, column
         self.position = vec(column * twidth, row * theight)
         self.color = (255, 255, 255)
         self.rad = int(2 * twidth / 16)
@@ -757,6 +1908,9 @@ class Pellet(object):
             p = self.position + adjust
             pygame.draw.circle(screen, self.color, p.asInt(), self.rad)
 
+    def getRect(self):
+        return pygame.Rect(self.col * twidth, self.row * theight, twidth, theight)
+
 
 class PowerPellet(Pellet):
     def __init__(self, row, column):
@@ -764,28 +1918,74 @@ class PowerPellet(Pellet):
         self.name = POWERPELLET
         self.rad = int(8 * twidth / 16)
         self.points = 50
-        self.ftime = 0.2
-        self.timer = 0
 
-    def update(self, dt):
-        self.timer += dt
-        if self.timer >= self.ftime:
-            self.visible = not self.visible
-            self.timer = 0
+    def blink(self):
+        self.visible = not self.visible
 
 
-class Spritesheet(object):
-    def __init__(self):
-        self.sheet = pygame.image.load('sprites/spritesheet.png').convert()
+class SpriteAtlas(object):
+    atlases = {}
+    loads = 0
+
+    def __init__(self, path, tilewidth, tileheight):
+        self.path = path
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.sheet = pygame.image.load(path).convert()
         col = self.sheet.get_at((0, 0))
         self.sheet.set_colorkey(col)
-        width = int(self.sheet.get_width() / BASETILEWIDTH * twidth)
-        height = int(self.sheet.get_height() / BASETILEHEIGHT * theight)
+        width = int(self.sheet.get_width() / BASETILEWIDTH * tilewidth)
+        height = int(self.sheet.get_height() / BASETILEHEIGHT * tileheight)
         self.sheet = pygame.transform.scale(self.sheet, (width, height))
+        self.frames = {}
+        self.hits = 0
+        self.misses = 0
+        SpriteAtlas.loads += 1
+
+    @classmethod
+    def get(cls, path='sprites/spritesheet.png', tilewidth=twidth, tileheight=theight):
+        key = (path, tilewidth, tileheight)
+        with CACHELOCK:
+            if key not in cls.atlases:
+                cls.atlases[key] = cls(path, tilewidth, tileheight)
+            return cls.atlases[key]
+
+    @classmethod
+    def clear(cls):
+        cls.atlases = {}
+
+    @classmethod
+    def stats(cls):
+        hits = sum(atlas.hits for atlas in cls.atlases.values())
+        misses = sum(atlas.misses for atlas in cls.atlases.values())
+        return {'loads': cls.loads, 'hits': hits, 'misses': misses}
+
+    def getFrame(self, x, y, width, height):
+        key = (x, y, width, height)
+        frame = self.frames.get(key)
+        if frame is None:
+            with CACHELOCK:
+                frame = self.frames.get(key)
+                if frame is None:
+                    self.misses += 1
+                    rect = pygame.Rect(x * self.tilewidth, y * self.tileheight, width, height)
+                    frame = self.sheet.subsurface(rect)
+                    self.frames[key] = frame
+                    return frame
+        self.hits += 1
+        return frame
+
+
+class Spritesheet(object):
+    def __init__(self):
+        self.atlas = SpriteAtlas.get()
+        self.sheet = self.atlas.sheet
 
     def getImage(self, x, y, width, height):
-        self.sheet.set_clip(pygame.Rect(x * twidth, y * theight, width, height))
-        return self.sheet.subsurface(self.sheet.get_clip())
+        return self.atlas.getFrame(x, y, width, height)
+
+    def getFrames(self, coords):
+        return tuple(self.getImage(*coord) for coord in coords)
 
 
 class PacmanSprites(Spritesheet):
@@ -795,34 +1995,28 @@ class PacmanSprites(Spritesheet):
         self.entity.image = self.getStartImage()
         self.animations = {}
         self.defineAnimations()
-        self.stopimage = (8, 0)
+        self.stopimages = {left: self.getImage(8, 0), right: self.getImage(10, 0),
+                           down: self.getImage(8, 2), up: self.getImage(10, 2)}
+        self.stopimage = self.stopimages[left]
 
     def defineAnimations(self):
-        self.animations[left] = Animator(((8, 0), (0, 0), (0, 2), (0, 0)))
-        self.animations[right] = Animator(((10, 0), (2, 0), (2, 2), (2, 0)))
-        self.animations[up] = Animator(((10, 2), (6, 0), (6, 2), (6, 0)))
-        self.animations[down] = Animator(((8, 2), (4, 0), (4, 2), (4, 0)))
-        self.animations[DEATH] = Animator(((0, 12), (2, 12), (4, 12), (6, 12), (8, 12), (
-            10, 12), (12, 12), (14, 12), (16, 12), (18, 12), (20, 12)), speed=6, loop=False)
+        self.animations[left] = Animator(self.getFrames(((8, 0), (0, 0), (0, 2), (0, 0))))
+        self.animations[right] = Animator(self.getFrames(((10, 0), (2, 0), (2, 2), (2, 0))))
+        self.animations[up] = Animator(self.getFrames(((10, 2), (6, 0), (6, 2), (6, 0))))
+        self.animations[down] = Animator(self.getFrames(((8, 2), (4, 0), (4, 2), (4, 0))))
+        self.animations[DEATH] = Animator(self.getFrames(((0, 12), (2, 12), (4, 12), (6, 12), (8, 12), (
+            10, 12), (12, 12), (14, 12), (16, 12), (18, 12), (20, 12))), speed=6, loop=False)
 
     def update(self, dt):
-        if self.entity.alive == True:
-            if self.entity.direction == left:
-                self.entity.image = self.getImage(*self.animations[left].update(dt))
-                self.stopimage = (8, 0)
-            elif self.entity.direction == right:
-                self.entity.image = self.getImage(*self.animations[right].update(dt))
-                self.stopimage = (10, 0)
-            elif self.entity.direction == down:
-                self.entity.image = self.getImage(*self.animations[down].update(dt))
-                self.stopimage = (8, 2)
-            elif self.entity.direction == up:
-                self.entity.image = self.getImage(*self.animations[up].update(dt))
-                self.stopimage = (10, 2)
-            elif self.entity.direction == stop:
-                self.entity.image = self.getImage(*self.stopimage)
+        if self.entity.alive:
+            direction = self.entity.direction
+            if direction == stop:
+                self.entity.image = self.stopimage
+            else:
+                self.entity.image = self.animations[direction].update(dt)
+                self.stopimage = self.stopimages[direction]
         else:
-            self.entity.image = self.getImage(*self.animations[DEATH].update(dt))
+            self.entity.image = self.animations[DEATH].update(dt)
 
     def reset(self):
         [self.animations[key].reset() for key in list(self.animations.keys())]
@@ -835,34 +2029,35 @@ class PacmanSprites(Spritesheet):
 
 
 class GhostSprites(Spritesheet):
+    tables = {}
+
     def __init__(self, entity):
         Spritesheet.__init__(self)
         self.x = {bli: 0, pin: 2, ink: 4, cly: 6}
         self.entity = entity
+        self.table = self.getTable(entity.name)
         self.entity.image = self.getStartImage()
 
+    def getTable(self, name):
+        key = (self.atlas, name)
+        with CACHELOCK:
+            if key not in GhostSprites.tables:
+                GhostSprites.tables[key] = self.defineTable(self.x[name])
+            return GhostSprites.tables[key]
+
+    def defineTable(self, x):
+        normal = {left: self.getImage(x, 8), right: self.getImage(x, 10),
+                  down: self.getImage(x, 6), up: self.getImage(x, 4)}
+        freight = self.getImage(10, 4)
+        spawn = {left: self.getImage(8, 8), right: self.getImage(8, 10),
+                 down: self.getImage(8, 6), up: self.getImage(8, 4)}
+        return {SCATTER: normal, CHASE: normal, SPAWN: spawn,
+                FREIGHT: {up: freight, down: freight, left: freight, right: freight, stop: freight}}
+
     def update(self, dt):
-        x = self.x[self.entity.name]
-        if self.entity.mode.cur in [SCATTER, CHASE]:
-            if self.entity.direction == left:
-                self.entity.image = self.getImage(x, 8)
-            elif self.entity.direction == right:
-                self.entity.image = self.getImage(x, 10)
-            elif self.entity.direction == down:
-                self.entity.image = self.getImage(x, 6)
-            elif self.entity.direction == up:
-                self.entity.image = self.getImage(x, 4)
-        elif self.entity.mode.cur == FREIGHT:
-            self.entity.image = self.getImage(10, 4)
-        elif self.entity.mode.cur == SPAWN:
-            if self.entity.direction == left:
-                self.entity.image = self.getImage(8, 8)
-            elif self.entity.direction == right:
-                self.entity.image = self.getImage(8, 10)
-            elif self.entity.direction == down:
-                self.entity.image = self.getImage(8, 6)
-            elif self.entity.direction == up:
-                self.entity.image = self.getImage(8, 4)
+        image = self.table[self.entity.mode.cur].get(self.entity.direction)
+        if image is not None:
+            self.entity.image = image
 
     def getStartImage(self):
         return self.getImage(self.x[self.entity.name], 4)
@@ -901,6 +2096,61 @@ class LifeSprites(Spritesheet):
         return Spritesheet.getImage(self, x, y, 2 * twidth, 2 * theight)
 
 
+class GlyphAtlas(object):
+    fonts = {}
+    atlases = {}
+
+    def __init__(self, font, color):
+        self.font = font
+        self.color = color
+        self.height = font.get_height()
+        self.glyphs = {}
+
+    @classmethod
+    def getFont(cls, path, size):
+        key = (path, size)
+        if key not in cls.fonts:
+            cls.fonts[key] = pygame.font.Font(path, size)
+        return cls.fonts[key]
+
+    @classmethod
+    def get(cls, path, size, color):
+        key = (path, size, tuple(color))
+        if key not in cls.atlases:
+            cls.atlases[key] = cls(cls.getFont(path, size), color)
+        return cls.atlases[key]
+
+    def getGlyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            glyph = self.font.render(char, 1, self.color)
+            self.glyphs[char] = glyph
+        return glyph
+
+    def compose(self, text):
+        glyphs = [self.getGlyph(char) for char in text]
+        label = pygame.Surface((sum(glyph.get_width() for glyph in glyphs), self.height), pygame.SRCALPHA)
+        x = 0
+        for glyph in glyphs:
+            label.blit(glyph, (x, 0), special_flags=pygame.BLEND_RGBA_MAX)
+            x += glyph.get_width()
+        return label
+
+    def replace(self, label, text, old):
+        if len(text) != len(old):
+            return False
+        glyphs = [self.getGlyph(char) for char in text]
+        if any(glyph.get_width() != self.getGlyph(char).get_width() for glyph, char in zip(glyphs, old)):
+            return False
+        x = 0
+        for glyph, char, oldchar in zip(glyphs, text, old):
+            if char != oldchar:
+                label.fill((0, 0, 0, 0), (x, 0, glyph.get_width(), self.height))
+                label.blit(glyph, (x, 0), special_flags=pygame.BLEND_RGBA_MAX)
+            x += glyph.get_width()
+        return True
+
+
 class Text(object):
     def __init__(self, text, color, x, y, size, time=None, id=None, visible=True):
         self.id = id
@@ -909,51 +2159,59 @@ class Text(object):
         self.size = size
         self.visible = visible
         self.position = vec(x, y)
-        self.timer = 0
         self.lifespan = time
         self.label = None
-        self.destroy = False
-        self.setupFont('fonts/PressStart2P-Regular.ttf')
-        self.createLabel()
+        self.font = None
+        self.atlas = None
 
     def setupFont(self, fontpath):
-        self.font = pygame.font.Font(fontpath, self.size)
+        self.font = GlyphAtlas.getFont(fontpath, self.size)
+        self.atlas = GlyphAtlas.get(fontpath, self.size, self.color)
 
     def createLabel(self):
-        self.label = self.font.render(self.text, 1, self.color)
+        self.label = self.atlas.compose(self.text)
 
-    def setText(self, newtext):
-        self.text = str(newtext)
-        self.createLabel()
+    def getLabel(self):
+        if self.label is None:
+            if self.font is None:
+                self.setupFont('fonts/PressStart2P-Regular.ttf')
+            self.createLabel()
+        return self.label
 
-    def update(self, dt):
-        if self.lifespan is not None:
-            self.timer += dt
-            if self.timer >= self.lifespan:
-                self.timer = 0
-                self.lifespan = None
-                self.destroy = True
+    def setText(self, newtext):
+        newtext = str(newtext)
+        if self.label is not None and not self.atlas.replace(self.label, newtext, self.text):
+            self.label = None
+        self.text = newtext
 
     def render(self, screen):
         if self.visible:
             x, y = self.position.asTuple()
-            screen.blit(self.label, (x, y))
+            screen.blit(self.getLabel(), (x, y))
+
+    def getRect(self):
+        return pygame.Rect(self.position.asInt(), self.getLabel().get_size())
 
 
 class TextGroup(object):
-    def __init__(self):
+    def __init__(self, timers=None):
         self.nextid = 10
         self.alltext = {}
+        self.timers = timers
         self.setupText()
         self.showText(READYTXT)
 
     def addText(self, text, color, x, y, size, time=None, id=None):
         self.nextid += 1
         self.alltext[self.nextid] = Text(text, color, x, y, size, time=time, id=id)
+        if time is not None and self.timers is not None:
+            self.timers.schedule(self.alltext[self.nextid], time, functools.partial(self.removeText, self.nextid))
         return self.nextid
 
     def removeText(self, id):
-        self.alltext.pop(id)
+        text = self.alltext.pop(id)
+        if self.timers is not None:
+            self.timers.cancel(text)
 
     def setupText(self):
         size = theight
@@ -965,12 +2223,6 @@ class TextGroup(object):
         self.addText('SCORE', (255, 255, 255), 0, 0, size)
         self.addText('LEVEL', (255, 255, 255), 23 * twidth, 0, size)
 
-    def update(self, dt):
-        for tkey in list(self.alltext.keys()):
-            self.alltext[tkey].update(dt)
-            if self.alltext[tkey].destroy:
-                self.removeText(tkey)
-
     def showText(self, id):
         self.hideText()
         self.alltext[id].visible = True
@@ -995,9 +2247,35 @@ class TextGroup(object):
 
 
 class vec(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x=0, y=0):
         self.x, self.y = x, y
 
+    def set(self, x, y):
+        self.x, self.y = x, y
+        return self
+
+    def iadd(self, other):
+        self.x += other.x
+        self.y += other.y
+        return self
+
+    def isub(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        return self
+
+    def imul(self, scalar):
+        self.x *= scalar
+        self.y *= scalar
+        return self
+
+    def addScaled(self, other, scalar):
+        self.x += other.x * scalar
+        self.y += other.y * scalar
+        return self
+
     def __add__(self, other):
         return vec(self.x + other.x, self.y + other.y)
 
@@ -1041,29 +2319,76 @@ class vec(object):
 
 
 class MazeSprites(Spritesheet):
-    def __init__(self, mazefile, rotfile):
+    backgrounds = {}
+    cachedir = None
+    cacheformat = 'png'
+
+    def __init__(self, level):
         Spritesheet.__init__(self)
-        self.data = self.readmz(mazefile)
-        self.rotdata = self.readmz(rotfile)
+        self.level = level
 
     def getImage(self, x, y):
         return Spritesheet.getImage(self, x, y, twidth, theight)
 
-    def readmz(self, mazefile):
-        return np.loadtxt(mazefile, dtype='<U1')
-
-    def consBG(self, bg, y):
-        for i in list(range(self.data.shape[0])):
-            for j in list(range(self.data.shape[1])):
-                if self.data[i][j].isdigit():
-                    x = int(self.data[i][j]) + 12
-                    sprite = self.getImage(x, y)
-                    rotval = int(self.rotdata[i][j])
-                    sprite = self.rotate(sprite, rotval)
-                    bg.blit(sprite, (j * twidth, i * theight))
-                elif self.data[i][j] == '=':
-                    sprite = self.getImage(10, 8)
-                    bg.blit(sprite, (j * twidth, i * theight))
+    def getBG(self, y):
+        key = (self.level.name, y, twidth, theight)
+        with CACHELOCK:
+            bg = MazeSprites.backgrounds.get(key)
+            if bg is None:
+                bg = self.loadBG(key)
+                if bg is None:
+                    bg = pygame.surface.Surface(SCREENSIZE).convert()
+                    bg.fill((0, 0, 0))
+                    self.consBG(bg, y)
+                    self.saveBG(key, bg)
+                MazeSprites.backgrounds[key] = bg
+            return bg
+
+    def getBGPath(self, key):
+        if MazeSprites.cachedir is None or self.level.source is None:
+            return
+        name = '%s-%d-%dx%d-%s.%s' % (key + (self.level.source[:12], MazeSprites.cacheformat))
+        return os.path.join(MazeSprites.cachedir, name)
+
+    def loadBG(self, key):
+        path = self.getBGPath(key)
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            if MazeSprites.cacheformat == 'raw':
+                with open(path, 'rb') as f:
+                    return pygame.image.frombuffer(f.read(), SCREENSIZE, 'RGB').convert()
+            return pygame.image.load(path).convert()
+        except (pygame.error, ValueError, OSError):
+            return
+
+    def saveBG(self, key, bg):
+        path = self.getBGPath(key)
+        if path is None:
+            return
+        try:
+            os.makedirs(MazeSprites.cachedir, exist_ok=True)
+            if MazeSprites.cacheformat == 'raw':
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(pygame.image.tostring(bg, 'RGB'))
+                os.replace(path + '.tmp', path)
+            else:
+                pygame.image.save(bg, path)
+        except (pygame.error, OSError):
+            pass
+
+    @classmethod
+    def clear(cls):
+        cls.backgrounds = {}
+
+    def consBG(self, bg, y, pellets=None):
+        for row, col, x, rotval in self.level.walls.tolist():
+            sprite = self.rotate(self.getImage(x, y), rotval)
+            bg.blit(sprite, (col * twidth, row * theight))
+        for row, col in self.level.doors.tolist():
+            bg.blit(self.getImage(10, 8), (col * twidth, row * theight))
+        if pellets is not None:
+            pellets.bake(bg)
         return bg
 
     def rotate(self, sprite, value):
@@ -1071,223 +2396,513 @@ class MazeSprites(Spritesheet):
 
 
 class PelletGroup(object):
-    def __init__(self, pelletfile):
-        self.pellist = []
+    def __init__(self, level):
+        self.lut = {}
         self.ppells = []
-        self.createpel(pelletfile)
+        self.colrad = 2 * twidth / 16
+        self.num = 0
+        self.layer = None
+        self.ftime = 0.2
+        self.timers = None
+        self.createpel(level)
         self.cnt = 0
 
-    def update(self, dt):
-        [powerpellet.update(dt) for powerpellet in self.ppells]
+    def startTimers(self, timers):
+        self.timers = timers
+        self.timers.schedule(self, self.ftime, self.blink)
 
-    def createpel(self, pelletfile):
-        data = self.readpel(pelletfile)
-        for i in range(data.shape[0]):
-            for j in range(data.shape[1]):
-                if data[i][j] in ['.', '+']:
-                    self.pellist.append(Pellet(i, j))
-                elif data[i][j] in ['P', 'p']:
-                    pp = PowerPellet(i, j)
-                    self.pellist.append(pp)
-                    self.ppells.append(pp)
+    def stopTimers(self):
+        if self.timers is not None:
+            self.timers.cancel(self)
 
-    def readpel(self, textfile):
-        return np.loadtxt(textfile, dtype='<U1')
+    def blink(self):
+        [powerpellet.blink() for powerpellet in self.ppells]
+        self.timers.schedule(self, self.ftime, self.blink)
+
+    def createpel(self, level):
+        self.grid = np.zeros(level.tiles.shape, dtype=bool)
+        for i, j, kind in level.pellets.tolist():
+            if kind == PELLET:
+                self.addPellet(Pellet(i, j))
+            else:
+                pp = PowerPellet(i, j)
+                self.addPellet(pp)
+                self.ppells.append(pp)
+        self.allpellets = dict(self.lut)
+        self.allppells = list(self.ppells)
+
+    def addPellet(self, pellet):
+        self.lut[(pellet.row, pellet.col)] = pellet
+        self.grid[pellet.row, pellet.col] = True
+        self.num += 1
+
+    def removePellet(self, pellet):
+        self.grid[pellet.row, pellet.col] = False
+        del self.lut[(pellet.row, pellet.col)]
+        if pellet.name == POWERPELLET:
+            self.ppells.remove(pellet)
+        elif self.layer is not None:
+            self.layer.fill((0, 0, 0), pellet.getRect())
+        self.num -= 1
+        self.cnt += 1
+
+    def getPellet(self, position, colrad):
+        pellets = self.getPellets(position, colrad)
+        if pellets:
+            return pellets[0]
+
+    def getPellets(self, position, colrad, start=None):
+        r = colrad + self.colrad
+        sx, sy = (position.x, position.y) if start is None else (start.x, start.y)
+        rows, cols = self.grid.shape
+        col0, col1 = max(int((min(sx, position.x) - r) // twidth), 0), min(int((max(sx, position.x) + r) // twidth), cols - 1)
+        row0, row1 = max(int((min(sy, position.y) - r) // theight), 0), min(int((max(sy, position.y) + r) // theight), rows - 1)
+        found = []
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                if self.grid[row, col]:
+                    x, y = col * twidth, row * theight
+                    dx, dy = position.x - x, position.y - y
+                    if dx * dx + dy * dy <= r * r or \
+                            start is not None and SpatialHash.sweep(sx, sy, position.x, position.y, x, y, x, y) <= r * r:
+                        found.append(((x - sx) ** 2 + (y - sy) ** 2, self.lut[(row, col)]))
+        return [pellet for d, pellet in sorted(found, key=lambda item: item[0])]
 
     def isEmpty(self):
-        return len(self.pellist) == 0
+        return self.num == 0
+
+    def getState(self):
+        return np.packbits(self.grid).tobytes(), self.num, self.cnt
+
+    def setState(self, state):
+        bits, self.num, self.cnt = state
+        if bits == np.packbits(self.grid).tobytes():
+            return
+        grid = np.unpackbits(np.frombuffer(bits, np.uint8), count=self.grid.size).reshape(self.grid.shape)
+        grid = grid.astype(bool)
+        power = False
+        rows, cols = (grid != self.grid).nonzero()
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            pellet = self.allpellets[(row, col)]
+            if grid[row, col]:
+                self.lut[(row, col)] = pellet
+                if pellet.name == PELLET and self.layer is not None:
+                    pellet.render(self.layer)
+            else:
+                del self.lut[(row, col)]
+                if pellet.name == PELLET and self.layer is not None:
+                    self.layer.fill((0, 0, 0), pellet.getRect())
+            power = power or pellet.name == POWERPELLET
+        if power:
+            self.ppells = [pellet for pellet in self.allppells if grid[pellet.row, pellet.col]]
+        self.grid = grid
+
+    def bake(self, bg):
+        self.layer = bg
+        [pellet.render(bg) for pellet in self.lut.values() if pellet.name == PELLET]
 
     def render(self, screen):
-        [pellet.render(screen) for pellet in self.pellist]
+        if self.layer is None:
+            [pellet.render(screen) for pellet in self.lut.values()]
+        else:
+            [pellet.render(screen) for pellet in self.ppells]
+
+
+class LevelLoader(threading.Thread):
+    def __init__(self, game, level):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.game = game
+        self.level = level
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.game.prepareLevel(self.level)
+        except Exception as error:
+            self.error = error
+
+    def get(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class GameState(object):
+    __slots__ = ('level', 'frame', 'lives', 'score', 'deaths', 'gameover', 'rng', 'pellets', 'access', 'pacman',
+                 'ghosts', 'fruit', 'pause')
 
 
 class GameController(object):
-    def __init__(self):
-        pygame.init()
-        self.screen = pygame.display.set_mode(SCREENSIZE, 0, 32)
+    def __init__(self, dirty=False, headless=False, inputs=None, autostart=False, seed=None, hz=30,
+                 fastforward=False, mazes=None, smart=False, horde=0, record=None, autorestart=True,
+                 profile=False):
+        self.headless = headless
+        self.screen = None
+        if not headless:
+            pygame.init()
+            self.screen = pygame.display.set_mode(SCREENSIZE, 0, 32)
+        if inputs is None:
+            inputs = InputSource() if headless else KeyboardInput()
+        self.inputs = inputs
+        self.autostart = autostart
+        self.autorestart = autorestart
+        self.smart = smart
+        self.horde = horde
+        if seed is None and record is not None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.hz = hz
+        self.stepdt = 1.0 / hz
+        self.fps = 30
+        self.maxframe = 0.25
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.frame = 0
+        self.ffsteps = 64
+        self.setFastForward(fastforward)
+        self.observers = []
+        self.dirty = dirty
+        self.drawn = {}
+        self.drawnbg = None
         self.bg = None
         self.bgn = None
         self.bgf = None
         self.clock = pygame.time.Clock()
+        self.timers = Scheduler(self.stepdt)
+        self.gametimers = Scheduler(self.stepdt)
         self.fruit = None
-        self.pause = Pause(True)
+        self.pellets = None
+        self.ghosts = None
+        self.pause = Pause(self.timers, True)
         self.level = 0
         self.lives = 5
         self.score = 0
-        self.TG = TextGroup()
-        self.lifesprites = LifeSprites(self.lives)
+        self.deaths = 0
+        self.gameover = False
+        self.TG = TextGroup(self.timers)
+        self.lifesprites = None
+        if not headless:
+            self.lifesprites = LifeSprites(self.lives)
+            self.addObserver(GameController.render)
         self.flashBG = False
         self.ftime = 0.2
-        self.ftimer = 0
         self.fruitsc = []
         self.fruitNode = None
-        self.mzdata = MazeData()
-
-    def setBG(self):
-        self.bgn = pygame.surface.Surface(SCREENSIZE).convert()
-        self.bgn.fill((0, 0, 0))
-        self.bgf = pygame.surface.Surface(SCREENSIZE).convert()
-        self.bgf.fill((0, 0, 0))
-        self.bgn = self.mazesprites.consBG(self.bgn, self.level % 5)
-        self.bgf = self.mazesprites.consBG(self.bgf, 5)
+        self.mzdata = MazeData(mazes)
+        self.loader = None
+        self.colliders = SpatialHash()
+        self.candidates = []
+        self.recorder = None
+        if record is not None:
+            self.recorder = ReplayRecorder(record, self)
+        self.profiler = FrameProfiler(visible=not headless) if profile else None
+
+    def addObserver(self, func):
+        self.observers.append(func)
+
+    def removeObserver(self, func):
+        self.observers.remove(func)
+
+    def setPaths(self, nodes, ghosts):
+        home = (nodes.nodesLUT[nodes.homekey], down)
+        extra = {ink: [home, (ghosts.inky.startNode, right)], cly: [home, (ghosts.clyde.startNode, left)]}
+        for ghost in ghosts.getPersonalities():
+            ghost.paths = nodes.getPaths(ghost.name, extra.get(ghost.name, [home]))
+            ghost.smart = self.smart
+            ghost.directionMethod = ghost.getGoalMethod()
+
+    def setSprites(self, pacman, ghosts):
+        pacman.sprites = PacmanSprites(pacman)
+        for ghost in ghosts.getPersonalities():
+            ghost.sprites = GhostSprites(ghost)
+
+    def makeBG(self, mazesprites, level, pellets):
+        bgn = mazesprites.getBG(level % 5).copy()
+        pellets.bake(bgn)
+        return bgn, mazesprites.getBG(5)
+
+    def startFlash(self):
+        self.flashBG = True
+        self.timers.schedule(self, self.ftime, self.flash)
+
+    def stopFlash(self):
         self.flashBG = False
+        self.timers.cancel(self)
         self.bg = self.bgn
 
+    def flash(self):
+        if self.bg == self.bgn:
+            self.bg = self.bgf
+        else:
+            self.bg = self.bgn
+        self.timers.schedule(self, self.ftime, self.flash)
+
     def start(self):
-        self.mzdata.loadMaze(self.level)
-        self.mazesprites = MazeSprites('levels/' + self.mzdata.obj.name + '.txt', 'levels/' + self.mzdata.obj.name + '_rotation.txt')
-        self.setBG()
-        self.nodes = NodeG('levels/' + self.mzdata.obj.name + '.txt')
-        self.mzdata.obj.setPortalPairs(self.nodes)
-        self.mzdata.obj.conHomnod(self.nodes)
-        self.pacman = Pacman(self.nodes.getNodeFromTiles(*self.mzdata.obj.pacmanStart))
-        self.pellets = PelletGroup('levels/' + self.mzdata.obj.name + '.txt')
-        self.ghosts = GhostGroup(self.nodes.getStartTempNode(), self.pacman)
-        self.ghosts.pinky.setStartNode(self.nodes.getNodeFromTiles(*self.mzdata.obj.addOffset(2, 3)))
-        self.ghosts.inky.setStartNode(self.nodes.getNodeFromTiles(*self.mzdata.obj.addOffset(0, 3)))
-        self.ghosts.clyde.setStartNode(self.nodes.getNodeFromTiles(*self.mzdata.obj.addOffset(4, 3)))
-        self.ghosts.setSpawnNode(self.nodes.getNodeFromTiles(*self.mzdata.obj.addOffset(2, 3)))
-        self.ghosts.blinky.setStartNode(self.nodes.getNodeFromTiles(*self.mzdata.obj.addOffset(2, 0)))
-        self.nodes.denyHomeAccess(self.pacman)
-        self.nodes.denyHomeAccessList(self.ghosts)
-        self.ghosts.inky.startNode.denyAccess(right, self.ghosts.inky)
-        self.ghosts.clyde.startNode.denyAccess(left, self.ghosts.clyde)
-        self.mzdata.obj.GhostsA(self.ghosts, self.nodes)
-
-    def starto(self):
-        self.mzdata.loadMaze(self.level)
-        self.mazesprites = MazeSprites('levels/maze1.txt', 'levels/maze1_rotation.txt')
-        self.setBG()
-        self.nodes = NodeG('levels/maze1.txt')
-        self.nodes.setPortalPair((0, 17), (27, 17))
-        homekey = self.nodes.createHomeNodes(11.5, 14)
-        self.nodes.conHomnod(homekey, (12, 14), left)
-        self.nodes.conHomnod(homekey, (15, 14), right)
-        self.pacman = Pacman(self.nodes.getNodeFromTiles(15, 26))
-        self.pellets = PelletGroup('levels/maze1.txt')
-        self.ghosts = GhostGroup(self.nodes.getStartTempNode(), self.pacman)
-        self.ghosts.blinky.setStartNode(self.nodes.getNodeFromTiles(2 + 11.5, 0 + 14))
-        self.ghosts.pinky.setStartNode(self.nodes.getNodeFromTiles(2 + 11.5, 3 + 14))
-        self.ghosts.inky.setStartNode(self.nodes.getNodeFromTiles(0 + 11.5, 3 + 14))
-        self.ghosts.clyde.setStartNode(self.nodes.getNodeFromTiles(4 + 11.5, 3 + 14))
-        self.ghosts.setSpawnNode(self.nodes.getNodeFromTiles(2 + 11.5, 3 + 14))
-        self.nodes.denyHomeAccess(self.pacman)
-        self.nodes.denyHomeAccessList(self.ghosts)
-        self.nodes.denyAccessList(2 + 11.5, 3 + 14, left, self.ghosts)
-        self.nodes.denyAccessList(2 + 11.5, 3 + 14, right, self.ghosts)
-        self.ghosts.inky.startNode.denyAccess(right, self.ghosts.inky)
-        self.ghosts.clyde.startNode.denyAccess(left, self.ghosts.clyde)
-        self.nodes.denyAccessList(12, 14, up, self.ghosts)
-        self.nodes.denyAccessList(15, 14, up, self.ghosts)
-        self.nodes.denyAccessList(12, 26, up, self.ghosts)
-        self.nodes.denyAccessList(15, 26, up, self.ghosts)
+        self.applyLevel(self.prepareLevel(self.level))
+
+    def prepareLevel(self, level):
+        maze = self.mzdata.getMaze(level)
+        data = LevelData.load(maze)
+        pellets = PelletGroup(data)
+        nodes = NodeG(data)
+        maze.conHomnod(nodes)
+        pacman = Pacman(nodes.getNodeFromTiles(*maze.pacmanStart))
+        if self.horde:
+            ghosts = GhostHorde(nodes.getStartTempNode(), pacman, self.rng, self.horde)
+        else:
+            ghosts = GhostGroup(nodes.getStartTempNode(), pacman, self.rng)
+        ghosts.pinky.setStartNode(nodes.getNodeFromTiles(*maze.addOffset(2, 3)))
+        ghosts.inky.setStartNode(nodes.getNodeFromTiles(*maze.addOffset(0, 3)))
+        ghosts.clyde.setStartNode(nodes.getNodeFromTiles(*maze.addOffset(4, 3)))
+        ghosts.setSpawnNode(nodes.getNodeFromTiles(*maze.addOffset(2, 3)))
+        ghosts.blinky.setStartNode(nodes.getNodeFromTiles(*maze.addOffset(2, 0)))
+        nodes.denyHomeAccess(pacman)
+        nodes.denyHomeAccessList(ghosts)
+        ghosts.inky.startNode.denyAccess(right, ghosts.inky)
+        ghosts.clyde.startNode.denyAccess(left, ghosts.clyde)
+        maze.GhostsA(ghosts, nodes)
+        nodes.toArrays()
+        self.setPaths(nodes, ghosts)
+        prepared = {'level': level, 'maze': maze, 'pellets': pellets, 'nodes': nodes, 'pacman': pacman,
+                    'ghosts': ghosts}
+        if not self.headless:
+            prepared['mazesprites'] = MazeSprites(data)
+            prepared['bgn'], prepared['bgf'] = self.makeBG(prepared['mazesprites'], level, pellets)
+            self.setSprites(pacman, ghosts)
+        return prepared
+
+    def applyLevel(self, prepared):
+        if self.pellets is not None:
+            self.pellets.stopTimers()
+            self.ghosts.stopTimers()
+        self.mzdata.obj = prepared['maze']
+        self.pellets = prepared['pellets']
+        self.nodes = prepared['nodes']
+        self.pacman = prepared['pacman']
+        self.ghosts = prepared['ghosts']
+        self.pellets.startTimers(self.timers)
+        self.ghosts.startTimers(self.gametimers)
+        if not self.headless:
+            self.mazesprites = prepared['mazesprites']
+            self.bgn, self.bgf = prepared['bgn'], prepared['bgf']
+        self.stopFlash()
+
+    def prefetchLevel(self, level):
+        self.loader = LevelLoader(self, level)
+        self.loader.start()
+
+    def setFastForward(self, fastforward):
+        self.fastforward = fastforward
+        self.pausescale = 0 if fastforward else 1
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.simframe = self.frame
+        self.simtime = time.perf_counter()
+
+    def getSimFPS(self):
+        elapsed = time.perf_counter() - self.simtime
+        if elapsed <= 0:
+            return 0.0
+        return (self.frame - self.simframe) / elapsed
+
+    def setTimedPause(self, pauseTime, func):
+        self.pause.setPause(pauseTime=pauseTime * self.pausescale, func=func)
 
     def update(self):
-        dt = self.clock.tick(30) / 1000.0
-        self.TG.update(dt)
-        self.pellets.update(dt)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin()
+        if self.fastforward:
+            self.clock.tick()
+            if profiler is not None:
+                profiler.mark(FrameProfiler.WAIT)
+            for i in range(self.ffsteps):
+                self.step()
+        else:
+            self.accumulator += min(self.clock.tick(self.fps) / 1000.0, self.maxframe)
+            if profiler is not None:
+                profiler.mark(FrameProfiler.WAIT)
+            while self.accumulator >= self.stepdt:
+                self.step()
+                self.accumulator -= self.stepdt
+            self.alpha = self.accumulator / self.stepdt
+        if not self.headless:
+            self.checkEv()
+        if profiler is not None:
+            profiler.mark(FrameProfiler.EVENTS)
+        [observer(self) for observer in self.observers]
+        if profiler is not None:
+            profiler.mark(FrameProfiler.RENDER)
+            profiler.end()
+
+    def step(self):
+        dt = self.stepdt
+        profiler = self.profiler
+        self.inputs.update(self)
+        if self.recorder is not None:
+            self.recorder.update(self)
+        self.frame += 1
+        if self.autostart and self.pause.paused and self.pause.pauseTime is None:
+            self.togglePause()
+        self.pacman.savePosition()
+        self.ghosts.savePositions()
+        self.pacman.key = self.inputs.getKey(self)
+        if self.recorder is not None:
+            self.recorder.setKey(self.frame, self.pacman.key)
+        if profiler is not None:
+            profiler.mark(FrameProfiler.INPUT)
         if not self.pause.paused:
+            self.gametimers.update()
+            if profiler is not None:
+                profiler.mark(FrameProfiler.TIMERS)
             self.ghosts.update(dt)
-            if self.fruit is not None:
-                self.fruit.update(dt)
+            if profiler is not None:
+                profiler.mark(FrameProfiler.GHOSTS)
+            self.updateColliders()
+            if profiler is not None:
+                profiler.mark(FrameProfiler.COLLIDERS)
             self.PellE()
+            if profiler is not None:
+                profiler.mark(FrameProfiler.PELLETS)
             self.ghostE()
+            if profiler is not None:
+                profiler.mark(FrameProfiler.GHOSTE)
             self.fruitE()
+            if profiler is not None:
+                profiler.mark(FrameProfiler.FRUITE)
+            self.pacman.setChecked()
         if self.pacman.alive:
             if not self.pause.paused:
                 self.pacman.update(dt)
         else:
             self.pacman.update(dt)
-        if self.flashBG:
-            self.ftimer += dt
-            if self.ftimer >= self.ftime:
-                self.ftimer = 0
-                if self.bg == self.bgn:
-                    self.bg = self.bgf
-                else:
-                    self.bg = self.bgn
-        afterPauseMethod = self.pause.update(dt)
-        if afterPauseMethod is not None:
-            afterPauseMethod()
-        self.checkEv()
-        self.render()
+        if profiler is not None:
+            profiler.mark(FrameProfiler.PACMAN)
+        self.timers.update()
+        if profiler is not None:
+            profiler.mark(FrameProfiler.TIMERS)
 
     def checkEv(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                self.stopRecording()
                 exit()
-            elif event.type == pygame.KEYDOWN:
+            elif event.type == pygame.KEYDOWN and not self.inputs.locked:
                 if event.key == pygame.K_SPACE:
-                    if self.pacman.alive:
-                        self.pause.setPause(playerPaused=True)
-                        if not self.pause.paused:
-                            self.TG.hideText()
-                            self.showEntities()
-                        else:
-                            self.TG.showText(PAUSETXT)
+                    self.togglePause()
+                    self.recordEvent(Replay.PAUSE)
+                elif event.key == pygame.K_f:
+                    self.setFastForward(not self.fastforward)
+                    self.recordEvent(Replay.FAST)
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_p and self.profiler is not None:
+                self.profiler.visible = not self.profiler.visible
+
+    def recordEvent(self, code):
+        if self.recorder is not None:
+            self.recorder.addEvent(self.frame, code)
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close(self)
+            self.recorder = None
+
+    def togglePause(self):
+        if self.pacman.alive:
+            self.pause.setPause(playerPaused=True)
+            if not self.pause.paused:
+                self.TG.hideText()
+                self.showEntities()
+            else:
+                self.TG.showText(PAUSETXT)
+
+    def updateColliders(self):
+        self.colliders.clear()
+        self.ghosts.addColliders(self.colliders)
+        if self.fruit is not None:
+            self.colliders.insert(self.fruit)
+        self.candidates = self.colliders.query(self.pacman, self.pacman.checked)
 
     def PellE(self):
-        pellet = self.pacman.eatPellets(self.pellets.pellist)
-        if pellet:
-            self.pellets.cnt += 1
+        for pellet in self.pacman.eatPellets(self.pellets):
+            self.pellets.removePellet(pellet)
             self.newScore(pellet.points)
             if self.pellets.cnt == 30:
                 self.ghosts.inky.startNode.allowAccess(right, self.ghosts.inky)
             if self.pellets.cnt == 70:
                 self.ghosts.clyde.startNode.allowAccess(left, self.ghosts.clyde)
-            self.pellets.pellist.remove(pellet)
             if pellet.name == POWERPELLET:
                 self.ghosts.startFreight()
             if self.pellets.isEmpty():
-                self.flashBG = True
+                self.startFlash()
                 self.hideEntities()
-                self.pause.setPause(pauseTime=3, func=self.next)
+                self.setTimedPause(3, self.next)
+                if self.pausescale:
+                    self.prefetchLevel(self.level + 1)
 
     def ghostE(self):
-        for ghost in self.ghosts:
-            if self.pacman.collideGhost(ghost):
-                if ghost.mode.cur is FREIGHT:
-                    self.pacman.visible = False
-                    ghost.visible = False
-                    self.newScore(ghost.points)
-                    self.TG.addText(str(ghost.points), (255, 255, 255), ghost.position.x, ghost.position.y, 8, time=1)
-                    self.ghosts.updatePoints()
-                    self.pause.setPause(pauseTime=1, func=self.showEntities)
-                    ghost.startSpawn()
-                    self.nodes.allowHomeAccess(ghost)
-                elif ghost.mode.cur is not SPAWN:
-                    if self.pacman.alive:
-                        self.lives -= 1
+        for ghost in self.ghosts.getCollisions(self.pacman, self.candidates):
+            if ghost.mode.cur is FREIGHT:
+                self.pacman.visible = False
+                ghost.visible = False
+                self.newScore(ghost.points)
+                self.TG.addText(str(ghost.points), (255, 255, 255), ghost.position.x, ghost.position.y, 8, time=1)
+                self.ghosts.updatePoints()
+                self.setTimedPause(1, self.showEntities)
+                ghost.startSpawn()
+                self.nodes.allowHomeAccess(ghost)
+            elif ghost.mode.cur is not SPAWN:
+                if self.pacman.alive:
+                    self.lives -= 1
+                    self.deaths += 1
+                    if self.lifesprites is not None:
                         self.lifesprites.removeImage()
-                        self.pacman.die()
-                        self.ghosts.hide()
-                        if self.lives <= 0:
-                            self.TG.showText(GAMEOVERTXT)
-                            self.pause.setPause(pauseTime=3, func=self.restart)
-                        else:
-                            self.pause.setPause(pauseTime=3, func=self.reset)
+                    self.pacman.die()
+                    self.ghosts.hide()
+                    if self.lives <= 0:
+                        self.gameover = True
+                        self.TG.showText(GAMEOVERTXT)
+                        self.setTimedPause(3, self.restart if self.autorestart else None)
+                    else:
+                        self.setTimedPause(3, self.reset)
 
     def fruitE(self):
         if self.pellets.cnt == 50 or self.pellets.cnt == 140:
             if self.fruit is None:
-                self.fruit = Fruit(self.nodes.getNodeFromTiles(9, 20), self.level)
-                print(self.fruit)
+                self.spawnFruit()
+                self.gametimers.schedule(self.fruit, self.fruit.lifespan, self.fruit.expire)
+                self.candidates.append(self.fruit)
         if self.fruit is not None:
-            if self.pacman.collideCheck(self.fruit):
+            if self.fruit in self.candidates and \
+                    self.pacman.collideCheck(self.fruit, self.pacman.getSweepStart(self.pacman.checked)):
                 self.newScore(self.fruit.points)
                 self.TG.addText(str(self.fruit.points), (255, 255, 255), self.fruit.position.x, self.fruit.position.y, 8,
                                        time=1)
-                fruitsc = False
-                for fruit in self.fruitsc:
-                    if fruit.get_offset() == self.fruit.image.get_offset():
-                        fruitsc = True
-                        break
-                if not fruitsc:
-                    self.fruitsc.append(self.fruit.image)
-                self.fruit = None
+                if self.fruit.image is not None:
+                    fruitsc = False
+                    for fruit in self.fruitsc:
+                        if fruit.get_offset() == self.fruit.image.get_offset():
+                            fruitsc = True
+                            break
+                    if not fruitsc:
+                        self.fruitsc.append(self.fruit.image)
+                self.removeFruit()
             elif self.fruit.destroy:
                 self.fruit = None
 
+    def spawnFruit(self):
+        self.fruit = Fruit(self.nodes.getNodeFromTiles(9, 20), self.level)
+        if not self.headless:
+            self.fruit.sprites = FruitSprites(self.fruit, self.level)
+
+    def removeFruit(self):
+        if self.fruit is not None:
+            self.gametimers.cancel(self.fruit)
+            self.fruit = None
+
     def showEntities(self):
         self.pacman.visible = True
         self.ghosts.show()
@@ -1300,40 +2915,106 @@ class GameController(object):
         self.showEntities()
         self.level += 1
         self.pause.paused = True
-        self.start()
+        if self.loader is not None and self.loader.level == self.level:
+            self.applyLevel(self.loader.get())
+        else:
+            self.start()
+        self.loader = None
         self.TG.updateLevel(self.level)
 
     def restart(self):
         self.lives = 5
+        self.deaths = 0
+        self.gameover = False
         self.level = 0
         self.pause.paused = True
-        self.fruit = None
+        self.removeFruit()
         self.start()
         self.score = 0
         self.TG.newScore(self.score)
         self.TG.updateLevel(self.level)
         self.TG.showText(READYTXT)
-        self.lifesprites.resetLives(self.lives)
+        if self.lifesprites is not None:
+            self.lifesprites.resetLives(self.lives)
         self.fruitsc = []
 
     def reset(self):
         self.pause.paused = True
         self.pacman.reset()
         self.ghosts.reset()
-        self.fruit = None
+        self.removeFruit()
         self.TG.showText(READYTXT)
 
     def newScore(self, points):
         self.score += points
         self.TG.newScore(self.score)
 
+    def snapshot(self):
+        state = GameState()
+        state.level = self.level
+        state.frame = self.frame
+        state.lives = self.lives
+        state.score = self.score
+        state.deaths = self.deaths
+        state.gameover = self.gameover
+        state.rng = self.rng.getstate()
+        state.pellets = self.pellets.getState()
+        state.access = self.nodes.getAccess()
+        state.pacman = self.pacman.getState()
+        state.ghosts = self.ghosts.getState()
+        state.fruit = None if self.fruit is None else self.fruit.getState(self.gametimers)
+        paused, pauseTime, func, ticks = self.pause.getState()
+        state.pause = paused, pauseTime, None if func is None else func.__name__, ticks
+        return state
+
+    def getChecksum(self):
+        state = self.snapshot()
+        return zlib.crc32(pickle.dumps([getattr(state, name) for name in GameState.__slots__], 4))
+
+    def restore(self, state):
+        if self.recorder is not None:
+            raise ValueError('cannot restore a snapshot while recording a replay')
+        if state.level != self.level:
+            self.level = state.level
+            self.start()
+            self.TG.updateLevel(self.level)
+        self.frame = state.frame
+        self.deaths = state.deaths
+        self.gameover = state.gameover
+        self.rng.setstate(state.rng)
+        if state.score != self.score:
+            self.score = state.score
+            self.TG.newScore(self.score)
+        if state.lives != self.lives:
+            self.lives = state.lives
+            if self.lifesprites is not None:
+                self.lifesprites.resetLives(self.lives)
+        self.pellets.setState(state.pellets)
+        self.nodes.setAccess(state.access)
+        self.pacman.setState(state.pacman)
+        self.ghosts.setState(state.ghosts)
+        if state.fruit is None:
+            self.removeFruit()
+        else:
+            if self.fruit is None:
+                self.spawnFruit()
+            self.fruit.setState(state.fruit, self.gametimers)
+        paused, pauseTime, func, ticks = state.pause
+        self.pause.setState((paused, pauseTime, None if func is None else getattr(self, func), ticks))
+
+    def setRenderMode(self, dirty):
+        self.dirty = dirty
+        self.drawnbg = None
+
     def render(self):
+        if self.dirty:
+            return self.renderDirty()
         self.screen.blit(self.bg, (0, 0))
         self.pellets.render(self.screen)
         if self.fruit is not None:
             self.fruit.render(self.screen)
-        self.pacman.render(self.screen)
-        self.ghosts.render(self.screen)
+        self.pacman.render(self.screen, self.alpha)
+        self.ghosts.render(self.screen, self.alpha)
         self.TG.render(self.screen)
         for i in range(len(self.lifesprites.images)):
             x = self.lifesprites.images[i].get_width() * i
@@ -1343,11 +3024,135 @@ class GameController(object):
             x = screenw - self.fruitsc[i].get_width() * (i + 1)
             y = screenh - self.fruitsc[i].get_height()
             self.screen.blit(self.fruitsc[i], (x, y))
+        if self.profiler is not None and self.profiler.visible:
+            self.screen.blit(self.profiler.getOverlay(), self.profiler.position)
         pygame.display.update()
 
+    def getDrawables(self):
+        items = []
+        for pellet in self.pellets.ppells:
+            if pellet.visible:
+                items.append((pellet, pellet.getRect().inflate(2, 2), None, pellet))
+        entities = [self.pacman]
+        if self.fruit is not None:
+            entities.insert(0, self.fruit)
+        for entity in entities:
+            if entity.visible:
+                rect = entity.getRect(self.alpha)
+                items.append(((entity.image, rect.x, rect.y), rect, entity.image, entity))
+        for ghost, rect in zip(self.ghosts, self.ghosts.getRects(self.alpha)):
+            if ghost.visible:
+                image = ghost.image
+                items.append(((image, rect.x, rect.y), rect, image, ghost))
+        for text in self.TG.alltext.values():
+            if text.visible:
+                rect = text.getRect()
+                items.append(((text.label, text.text, rect.x, rect.y), rect, text.label, text))
+        for i in range(len(self.lifesprites.images)):
+            image = self.lifesprites.images[i]
+            rect = image.get_rect(bottomleft=(image.get_width() * i, screenh))
+            items.append(((image, rect.x, rect.y), rect, image, None))
+        for i in range(len(self.fruitsc)):
+            image = self.fruitsc[i]
+            rect = image.get_rect(bottomright=(screenw - image.get_width() * i, screenh))
+            items.append(((image, rect.x, rect.y), rect, image, None))
+        if self.profiler is not None and self.profiler.visible:
+            image = self.profiler.getOverlay()
+            rect = image.get_rect(topleft=self.profiler.position)
+            items.append(((image, rect.x, rect.y), rect, image, None))
+        return items
+
+    def renderDirty(self):
+        items = self.getDrawables()
+        drawn = dict((item[0], item[1]) for item in items)
+        if self.bg is not self.drawnbg:
+            self.screen.set_clip(None)
+            self.screen.blit(self.bg, (0, 0))
+            [self.draw(item) for item in items]
+            pygame.display.update()
+        else:
+            dirty = [rect for key, rect in self.drawn.items() if key not in drawn]
+            dirty += [rect for key, rect in drawn.items() if key not in self.drawn]
+            rects = [item[1] for item in items]
+            for rect in dirty:
+                self.screen.set_clip(rect)
+                self.screen.blit(self.bg, rect, rect)
+                [self.draw(items[i]) for i in rect.collidelistall(rects)]
+            self.screen.set_clip(None)
+            pygame.display.update(dirty)
+        self.drawn = drawn
+        self.drawnbg = self.bg
+
+    def draw(self, item):
+        key, rect, image, obj = item
+        if image is not None:
+            self.screen.blit(image, rect)
+        else:
+            obj.render(self.screen)
+
 
 if __name__ == '__main__':
-    game = GameController()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dirty', action='store_true', help='redraw only changed screen rectangles')
+    parser.add_argument('--headless', action='store_true', help='run the simulation without a window')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the game random number generator')
+    parser.add_argument('--hz', type=int, default=30, help='simulation steps per second')
+    parser.add_argument('--fast', action='store_true', help='step the simulation as fast as possible')
+    parser.add_argument('--smart', action='store_true', help='chasing ghosts follow shortest paths')
+    parser.add_argument('--bg-cache', default=None, help='directory for rendered maze backgrounds')
+    parser.add_argument('--horde', type=int, default=0, help='number of ghosts for the array-backed horde mode')
+    parser.add_argument('--record', default=None, help='write an input replay of this session to a file')
+    parser.add_argument('--replay', default=None,
+                        help='play back a replay file, as fast as possible with --headless, else in real time')
+    parser.add_argument('--profile', action='store_true',
+                        help='time each frame by stage and show a p50/p99 overlay (toggle with P)')
+    parser.add_argument('--profile-out', default=None,
+                        help='write the frame timings to a .csv or .json file at exit (implies --profile)')
+    args = parser.parse_args()
+    MazeSprites.cachedir = args.bg_cache
+    profile = args.profile or args.profile_out is not None
+
+    def stopProfiling(game):
+        if game.profiler is not None:
+            if args.profile_out is not None:
+                game.profiler.export(args.profile_out)
+            print('\n'.join(game.profiler.getLines()))
+
+    if args.replay is not None:
+        replay = ReplayInput(args.replay)
+        game = GameController(dirty=args.dirty, headless=args.headless, inputs=replay, profile=profile,
+                              **replay.getOptions())
+        game.level = replay.header['level']
+        game.start()
+        start = time.perf_counter()
+        try:
+            while not replay.isDone(game):
+                if not args.headless:
+                    game.update()
+                elif game.profiler is None:
+                    game.step()
+                else:
+                    game.profiler.begin()
+                    game.step()
+                    game.profiler.end()
+        finally:
+            stopProfiling(game)
+        elapsed = time.perf_counter() - start
+        print('replayed %d frames in %.2f s (%.0f frames/s), score %d, level %d, %d checksums ok, mismatches at %s' % (
+            game.frame, elapsed, game.frame / max(elapsed, 1e-9), game.score, game.level + 1, replay.checked,
+            replay.mismatches or 'none'))
+        exit(1 if replay.mismatches else 0)
+    game = GameController(dirty=args.dirty, headless=args.headless, autostart=args.headless, seed=args.seed, hz=args.hz,
+                          fastforward=args.fast, smart=args.smart, horde=args.horde, record=args.record,
+                          profile=profile)
     game.start()
-    while True:
-        game.update()
\ No newline at end of file
+    report = game.frame
+    try:
+        while True:
+            game.update()
+            if game.fastforward and game.frame - report >= 60 * game.hz:
+                report = game.frame
+                print('frame %d: %.0f simulated frames per second' % (game.frame, game.getSimFPS()))
+    finally:
+        game.stopRecording()
+        stopProfiling(game)
\ No newline at end of file
@@ -0,0 +1,30 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import env
+
+
+def runFreight(gameenv, seed, steps=40):
+    gameenv.reset(seed)
+    gameenv.game.ghosts.startFreight()
+    for i in range(steps):
+        obs = gameenv.step(0)[0]
+    return obs['ghosts'].copy()
+
+
+class GameEnvTest(unittest.TestCase):
+    def testHordeReset(self):
+        gameenv = env.GameEnv('symbolic', seed=0, horde=64)
+        first = runFreight(gameenv, 1)
+        self.assertEqual(first.tolist(), runFreight(gameenv, 1).tolist())
+        self.assertNotEqual(first.tolist(), runFreight(gameenv, 2).tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import pygame
+
+import main
+import batch
+
+
+def makeGame(horde, dirty):
+    game = main.GameController(dirty=dirty, seed=3, autostart=True, inputs=batch.RandomPolicy(3), horde=horde)
+    game.start()
+    game.screen = pygame.Surface(main.SCREENSIZE)
+    game.setRenderMode(dirty)
+    return game
+
+
+def getState(game):
+    return [(ghost.position.asTuple(), ghost.direction, ghost.mode.cur, ghost.visible) for ghost in game.ghosts]
+
+
+class HordeRenderTest(unittest.TestCase):
+    def compare(self, dirty, frames=2000, minframes=1000):
+        classic, horde = makeGame(0, dirty), makeGame(4, dirty)
+        for frame in range(frames):
+            classic.step()
+            horde.step()
+            if getState(classic) != getState(horde):
+                break
+            classic.render()
+            horde.render()
+            self.assertEqual(pygame.image.tobytes(classic.screen, 'RGB'), pygame.image.tobytes(horde.screen, 'RGB'),
+                             'frame %d differs' % frame)
+        self.assertGreaterEqual(frame, minframes)
+
+    def testFullRender(self):
+        self.compare(False)
+
+    def testDirtyRender(self):
+        self.compare(True)
+
+    def testRects(self):
+        classic, horde = makeGame(0, False), makeGame(4, False)
+        for frame in range(120):
+            classic.step()
+            horde.step()
+        for ghost, hordeghost in zip(classic.ghosts, horde.ghosts):
+            self.assertEqual(ghost.getRect(), hordeghost.getRect())
+        for alpha in (0.5, 1.0):
+            self.assertEqual(horde.ghosts.getRects(alpha), [ghost.getRect(alpha) for ghost in horde.ghosts])
+
+
+if __name__ == '__main__':
+    unittest.main()
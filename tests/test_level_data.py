@@ -0,0 +1,56 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import numpy as np
+
+import main
+
+
+class LevelDataTest(unittest.TestCase):
+    def setUp(self):
+        self.maze = main.Maze1()
+        self.tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp, 'levels'))
+        for suffix in ('.txt', '_rotation.txt'):
+            shutil.copy(os.path.join(ROOT, 'levels', self.maze.name + suffix), os.path.join(self.tmp, 'levels'))
+        os.chdir(self.tmp)
+        self.path = os.path.join('levels', self.maze.name + '.lvl')
+        self.expected = main.LevelData.load(self.maze)
+        with open(self.path, 'rb') as f:
+            self.good = f.read()
+
+    def tearDown(self):
+        os.chdir(ROOT)
+        shutil.rmtree(self.tmp)
+
+    def checkRecompiles(self, data):
+        for mmap in (False, True):
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            level = main.LevelData.load(self.maze, mmap)
+            for field in main.LevelData.fields:
+                np.testing.assert_array_equal(getattr(level, field), getattr(self.expected, field))
+            del level
+            with open(self.path, 'rb') as f:
+                self.assertEqual(f.read(), self.good)
+
+    def testTruncated(self):
+        self.checkRecompiles(self.good[:-40])
+
+    def testTruncatedHeader(self):
+        self.checkRecompiles(self.good[:20])
+
+    def testBadMagic(self):
+        self.checkRecompiles(b'NOTALVL!' + self.good[8:])
+
+
+if __name__ == '__main__':
+    unittest.main()
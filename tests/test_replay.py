@@ -0,0 +1,81 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import main
+import batch
+
+
+def record(path, seed=2, frames=1200):
+    game = main.GameController(headless=True, autostart=True, seed=seed, inputs=batch.GreedyPolicy(seed, 0.1),
+                               record=path)
+    game.start()
+    for i in range(frames):
+        game.step()
+    game.stopRecording()
+    return game
+
+
+def replay(path):
+    inputs = main.ReplayInput(path)
+    game = main.GameController(headless=True, inputs=inputs, **inputs.getOptions())
+    game.level = inputs.header['level']
+    game.start()
+    while not inputs.isDone(game):
+        game.step()
+    return game, inputs
+
+
+def runMain(path):
+    return subprocess.run([sys.executable, 'main.py', '--headless', '--replay', path], cwd=ROOT,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'game.rep')
+        self.recorded = record(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testRoundTrip(self):
+        game, inputs = replay(self.path)
+        self.assertEqual(inputs.mismatches, [])
+        self.assertEqual(inputs.checked, self.recorded.frame // main.Replay.interval)
+        self.assertEqual((game.frame, game.getChecksum()), (self.recorded.frame, self.recorded.getChecksum()))
+        self.assertEqual(runMain(self.path), 0)
+
+    def testTamperedChecksum(self):
+        header, events = main.Replay.read(self.path)
+        frame, code, value = [event for event in events if event[1] == main.Replay.CHECK][1]
+        with open(self.path, 'rb') as f:
+            buf = bytearray(f.read())
+        i = buf.index(bytes((code,)) + value.to_bytes(4, 'little'), len(main.Replay.magic)) + 1
+        buf[i] ^= 0xff
+        with open(self.path, 'wb') as f:
+            f.write(buf)
+        game, inputs = replay(self.path)
+        self.assertEqual(inputs.mismatches, [frame])
+        self.assertEqual(runMain(self.path), 1)
+
+    def testRestoreWhileRecording(self):
+        game = main.GameController(headless=True, autostart=True, seed=2, record=os.path.join(self.tmp, 'b.rep'))
+        game.start()
+        state = game.snapshot()
+        game.step()
+        self.assertRaises(ValueError, game.restore, state)
+        game.stopRecording()
+
+
+if __name__ == '__main__':
+    unittest.main()
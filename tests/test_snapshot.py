@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import main
+import batch
+
+
+def makeGame(horde=0, seed=1):
+    game = main.GameController(headless=True, autostart=True, seed=seed, horde=horde,
+                               inputs=batch.GreedyPolicy(seed, 0.02))
+    game.start()
+    return game
+
+
+def prune(game, keep=(26,)):
+    for pellet in list(game.pellets.lut.values()):
+        if pellet.row not in keep and pellet.name == main.PELLET:
+            game.pellets.removePellet(pellet)
+    game.pellets.cnt = 0
+
+
+def run(game, frames):
+    game.inputs.rng.seed(game.frame)
+    checksums = []
+    for i in range(frames):
+        game.step()
+        checksums.append(game.getChecksum())
+    return checksums
+
+
+class SnapshotTest(unittest.TestCase):
+    def check(self, game, before, after):
+        run(game, before)
+        state = game.snapshot()
+        checksum = game.getChecksum()
+        level = game.level
+        first = run(game, after)
+        reached = game.level
+        game.restore(state)
+        self.assertEqual(checksum, game.getChecksum())
+        self.assertEqual(first, run(game, after))
+        return level, reached
+
+    def testClassic(self):
+        self.check(makeGame(), 500, 300)
+
+    def testHorde(self):
+        self.check(makeGame(horde=16), 500, 300)
+
+    def testLevelChange(self):
+        game = makeGame()
+        prune(game)
+        level, reached = self.check(game, 1200, 400)
+        self.assertEqual((level, reached), (0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
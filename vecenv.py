@@ -0,0 +1,334 @@
+import numpy as np
+
+import main
+
+UP, DOWN, LEFT, RIGHT, STOP = range(5)
+PORT = 4
+ACTIONS = (main.up, main.down, main.left, main.right, main.stop)
+REVERSE = np.array([DOWN, UP, RIGHT, LEFT, STOP])
+VECTORS = np.array([(0, -1), (0, 1), (-1, 0), (1, 0), (0, 0)], dtype=float)
+SHOW, RESET, GAMEOVER = 1, 2, 3
+
+
+class VecEnv(object):
+    def __init__(self, num, seed=None, level=0, mazes=None, hz=30, pausescale=0, autoreset=True):
+        self.num = num
+        self.rng = np.random.default_rng(seed)
+        self.dt = 1.0 / hz
+        self.pausescale = pausescale
+        self.autoreset = autoreset
+        self.level = level
+        game = main.GameController(headless=True, mazes=mazes)
+        game.level = level
+        game.start()
+        self.loadLayout(game)
+        self.allocate()
+        self.reset()
+
+    def loadLayout(self, game):
+        nodes = game.nodes
+        self.graph = nodes.graph
+        self.nodepos = self.graph.position
+        self.nbr = self.graph.neighbors
+        self.acc = self.graph.access
+        ghosts = game.ghosts.ghosts
+        self.ghostclasses = [type(ghost) for ghost in ghosts]
+        self.names = [ghost.name for ghost in ghosts]
+        self.scattergoals = np.array([(cls.scatterGoal[0] * main.twidth, cls.scatterGoal[1] * main.theight)
+                                      for cls in self.ghostclasses], dtype=float)
+        self.ghoststart = np.array([ghost.startNode.id for ghost in ghosts])
+        self.spawnnode = ghosts[0].spawnNode.id
+        self.spawnhop = np.stack([ghost.paths.nexthop[:, self.spawnnode] for ghost in ghosts], 1).astype(np.int64)
+        self.spawncost = []
+        for ghost in ghosts:
+            dist = ghost.paths.dist
+            nbr = np.maximum(self.nbr[:, :4], 0)
+            cost = dist[np.arange(len(nbr))[:, None], nbr] + dist[nbr, self.spawnnode]
+            self.spawncost.append(np.where(self.nbr[:, :4] >= 0, cost, np.inf))
+        self.homenode = nodes.nodesLUT[nodes.homekey].id
+        self.inky = self.ghostclasses.index(main.Inky)
+        self.clyde = self.ghostclasses.index(main.Clyde)
+        self.inkystart = game.ghosts.inky.startNode.id
+        self.clydestart = game.ghosts.clyde.startNode.id
+        self.pacstart = game.pacman.startNode.id
+        self.pacstarttarget = game.pacman.target.id
+        self.pacstartpos = game.pacman.position.asTuple()
+        self.pacrad = game.pacman.colrad
+        self.ghostrad = ghosts[0].colrad
+        mainmode = main.MainMode()
+        self.scattertime = mainmode.time
+        mainmode.chase()
+        self.chasetime = mainmode.time
+        modes = main.ModeController(None)
+        modes.setFreightMode()
+        self.freighttime = modes.time
+        self.speeds = np.array([100, 100, 50, 150], dtype=float) * main.twidth / 16
+        self.pacspeed = game.pacman.speed
+        self.pellets0 = game.pellets.grid.copy()
+        self.points0 = np.zeros(self.pellets0.shape, dtype=np.int64)
+        for pellet in game.pellets.lut.values():
+            self.points0[pellet.row, pellet.col] = pellet.points
+        self.pelletrad = game.pellets.colrad
+        fruitnode = nodes.getNodeFromTiles(9, 20)
+        self.hasfruit = fruitnode is not None
+        if self.hasfruit:
+            fruit = main.Fruit(fruitnode, self.level)
+            self.fruitpos = np.array(fruit.position.asTuple())
+            self.fruitpoints = fruit.points
+            self.fruitlifespan = fruit.lifespan
+            self.fruitrad = fruit.colrad
+
+    def allocate(self):
+        n, g = self.num, len(self.ghostclasses)
+        self.index = np.arange(n)
+        self.pacnode = np.zeros(n, dtype=np.int64)
+        self.pactarget = np.zeros(n, dtype=np.int64)
+        self.pacpos = np.zeros((n, 2))
+        self.pacdir = np.zeros(n, dtype=np.int64)
+        self.alive = np.ones(n, dtype=bool)
+        self.gnode = np.zeros((n, g), dtype=np.int64)
+        self.gtarget = np.zeros((n, g), dtype=np.int64)
+        self.gpos = np.zeros((n, g, 2))
+        self.gdir = np.zeros((n, g), dtype=np.int64)
+        self.gmode = np.zeros((n, g), dtype=np.int64)
+        self.gtimer = np.zeros((n, g))
+        self.ggoal = np.zeros((n, g, 2))
+        self.mainmode = np.zeros(n, dtype=np.int64)
+        self.maintimer = np.zeros(n)
+        self.pellets = np.zeros((n,) + self.pellets0.shape, dtype=bool)
+        self.remaining = np.zeros(n, dtype=np.int64)
+        self.eaten = np.zeros(n, dtype=np.int64)
+        self.score = np.zeros(n, dtype=np.int64)
+        self.lives = np.zeros(n, dtype=np.int64)
+        self.points = np.zeros(n, dtype=np.int64)
+        self.paused = np.zeros(n, dtype=bool)
+        self.pausetime = np.zeros(n)
+        self.pausetimer = np.zeros(n)
+        self.after = np.zeros(n, dtype=np.int64)
+        self.fruittimer = np.zeros(n)
+        self.steps = np.zeros(n, dtype=np.int64)
+        self.done = np.zeros(n, dtype=bool)
+        self.cleared = np.zeros(n, dtype=bool)
+
+    def reset(self, mask=None):
+        idx = self.index if mask is None else self.index[mask]
+        self.pellets[idx] = self.pellets0
+        self.remaining[idx] = self.pellets0.sum()
+        self.eaten[idx] = 0
+        self.score[idx] = 0
+        self.lives[idx] = 5
+        self.points[idx] = 200
+        self.paused[idx] = False
+        self.after[idx] = 0
+        self.fruittimer[idx] = -1
+        self.steps[idx] = 0
+        self.done[idx] = False
+        self.cleared[idx] = False
+        self.mainmode[idx] = main.SCATTER
+        self.maintimer[idx] = 0
+        self.gmode[idx] = main.SCATTER
+        self.gtimer[idx] = 0
+        self.resetPositions(idx)
+        return self.observe()
+
+    def resetPositions(self, idx):
+        self.pacnode[idx] = self.pacstart
+        self.pactarget[idx] = self.pacstarttarget
+        self.pacpos[idx] = self.pacstartpos
+        self.pacdir[idx] = LEFT
+        self.alive[idx] = True
+        self.gnode[idx] = self.ghoststart
+        self.gtarget[idx] = self.ghoststart
+        self.gpos[idx] = self.nodepos[self.ghoststart]
+        self.gdir[idx] = STOP
+        self.points[idx] = 200
+        self.fruittimer[idx] = -1
+
+    def observe(self):
+        size = np.array(main.SCREENSIZE, dtype=np.float32)
+        return np.concatenate([self.pacpos / size, self.pacdir[:, None], (self.gpos / size).reshape(self.num, -1),
+                               self.gmode, self.mainmode[:, None]], axis=1).astype(np.float32)
+
+    def validMask(self, node, name):
+        return (self.nbr[node, :4] >= 0) & ((self.acc[node] >> name) & 1).astype(bool)
+
+    def ghostValid(self, node, g):
+        valid = self.validMask(node, self.names[g])
+        valid[:, DOWN] |= (node == self.homenode) & (self.gmode[:, g] == main.SPAWN) & (self.nbr[node, DOWN] >= 0)
+        if g == self.inky:
+            valid[:, RIGHT] |= (node == self.inkystart) & (self.eaten >= 30) & (self.nbr[node, RIGHT] >= 0)
+        if g == self.clyde:
+            valid[:, LEFT] |= (node == self.clydestart) & (self.eaten >= 70) & (self.nbr[node, LEFT] >= 0)
+        return valid
+
+    def newTarget(self, node, direction, valid):
+        ok = (direction < 4) & valid[self.index, np.minimum(direction, 3)]
+        return np.where(ok, self.nbr[node, np.minimum(direction, 3)], node)
+
+    def overshot(self, node, target, position):
+        d1 = self.nodepos[target] - self.nodepos[node]
+        d2 = position - self.nodepos[node]
+        return (d2 ** 2).sum(1) >= (d1 ** 2).sum(1)
+
+    def step(self, actions):
+        keys = np.asarray(actions, dtype=np.int64)
+        act = ~self.paused & ~self.done
+        score = self.score.copy()
+        self.steps += ~self.done
+        self.updateModes(act)
+        for g in range(len(self.ghostclasses)):
+            self.moveGhost(g, act)
+        if self.hasfruit:
+            self.fruittimer[act & (self.fruittimer >= 0)] += self.dt
+        self.eatPellets(act)
+        self.collideGhosts(act)
+        if self.hasfruit:
+            self.collideFruit(act)
+        self.movePacman(keys, ~self.paused & ~self.done & self.alive)
+        self.updatePause()
+        reward = self.score - score
+        done = self.done.copy()
+        obs = self.observe()
+        if self.autoreset and done.any():
+            self.reset(done)
+            obs = self.observe()
+        return obs, reward, done
+
+    def updateModes(self, act):
+        self.maintimer[act] += self.dt
+        scatter = self.mainmode == main.SCATTER
+        flip = act & (self.maintimer >= np.where(scatter, self.scattertime, self.chasetime))
+        self.mainmode[flip] = np.where(scatter[flip], main.CHASE, main.SCATTER)
+        self.maintimer[flip] = 0
+
+    def chaseGoals(self, g):
+        cls = self.ghostclasses[g]
+        pacvec = VECTORS[self.pacdir] * main.twidth
+        if cls is main.Pinky:
+            return self.pacpos + pacvec * cls.lead
+        if cls is main.Inky:
+            blinky = self.gpos[:, self.ghostclasses.index(main.Blinky)]
+            return blinky + (self.pacpos + pacvec * cls.lead - blinky) * 2
+        if cls is main.Clyde:
+            near = ((self.pacpos - self.gpos[:, g]) ** 2).sum(1) <= (main.twidth * cls.shyness) ** 2
+            return np.where(near[:, None], self.scattergoals[g], self.pacpos + pacvec * cls.lead)
+        return self.pacpos.copy()
+
+    def moveGhost(self, g, act):
+        mode = self.gmode[:, g]
+        freight = act & (mode == main.FREIGHT)
+        self.gtimer[freight, g] += self.dt
+        normal = (freight & (self.gtimer[:, g] >= self.freighttime)) | (act & ((mode == main.SCATTER) | (mode == main.CHASE)))
+        mode[normal] = self.mainmode[normal]
+        home = act & (mode == main.SPAWN) & (self.gnode[:, g] == self.spawnnode)
+        mode[home] = self.mainmode[home]
+        goal = self.ggoal[:, g]
+        goal[act & (mode == main.SCATTER)] = self.scattergoals[g]
+        chase = act & (mode == main.CHASE)
+        goal[chase] = self.chaseGoals(g)[chase]
+        goal[act & (mode == main.SPAWN)] = self.nodepos[self.spawnnode]
+
+        node, target, direction = self.gnode[:, g], self.gtarget[:, g], self.gdir[:, g]
+        position = self.gpos[:, g] + VECTORS[direction] * (self.speeds[mode] * self.dt)[:, None]
+        arrived = act & self.overshot(node, target, position)
+        node = np.where(arrived, target, node)
+        choices = self.ghostValid(node, g) & (np.arange(4) != REVERSE[direction][:, None])
+        ahead = self.nodepos[node][:, None, :] + VECTORS[:4] * main.twidth - goal[:, None, :]
+        score = np.where(choices, -(ahead ** 2).sum(2), -np.inf)
+        rand = np.where(choices, self.rng.random(choices.shape), -1.0)
+        choice = np.where(mode == main.FREIGHT, rand.argmax(1), score.argmax(1))
+        hop = self.spawnhop[node, g]
+        hop = np.where(hop == PORT, self.spawnhop[self.nbr[node, PORT], g], hop)
+        hopok = (hop >= 0) & (hop < PORT) & choices[self.index, np.clip(hop, 0, PORT - 1)]
+        cost = np.where(choices, self.spawncost[g][node], np.inf)
+        spawn = (mode == main.SPAWN) & (hopok | np.isfinite(cost).any(1))
+        choice = np.where(spawn, np.where(hopok, hop, cost.argmin(1)), choice)
+        choice = np.where(choices.any(1), choice, REVERSE[direction])
+        node = np.where(arrived & (self.nbr[node, PORT] >= 0), self.nbr[node, PORT], node)
+        valid = self.ghostValid(node, g)
+        newtarget = self.newTarget(node, choice, valid)
+        moved = newtarget != node
+        newtarget = np.where(moved, newtarget, self.newTarget(node, direction, valid))
+        self.gdir[:, g] = np.where(arrived & moved, choice, direction)
+        self.gtarget[:, g] = np.where(arrived, newtarget, target)
+        self.gnode[:, g] = node
+        self.gpos[:, g] = np.where(arrived[:, None], self.nodepos[node], np.where(act[:, None], position, self.gpos[:, g]))
+
+    def movePacman(self, keys, act):
+        node, target, direction = self.pacnode, self.pactarget, self.pacdir
+        position = self.pacpos + VECTORS[direction] * self.pacspeed * self.dt
+        arrived = act & self.overshot(node, target, position)
+        node = np.where(arrived, target, node)
+        node = np.where(arrived & (self.nbr[node, PORT] >= 0), self.nbr[node, PORT], node)
+        valid = self.validMask(node, main.PACMAN)
+        newtarget = self.newTarget(node, keys, valid)
+        moved = newtarget != node
+        newdir = np.where(moved, keys, direction)
+        newtarget = np.where(moved, newtarget, self.newTarget(node, direction, valid))
+        newdir = np.where(newtarget == node, STOP, newdir)
+        reverse = act & ~arrived & (keys != STOP) & (keys == REVERSE[direction])
+        self.pacdir = np.where(arrived, newdir, np.where(reverse, REVERSE[direction], direction))
+        self.pactarget = np.where(arrived, newtarget, np.where(reverse, self.pacnode, target))
+        self.pacnode = np.where(reverse, target, node)
+        self.pacpos = np.where(arrived[:, None], self.nodepos[node], np.where(act[:, None], position, self.pacpos))
+
+    def eatPellets(self, act):
+        rows, cols = self.pellets0.shape
+        col = np.clip(np.floor(self.pacpos[:, 0] / main.twidth + 0.5).astype(np.int64), 0, cols - 1)
+        row = np.clip(np.floor(self.pacpos[:, 1] / main.theight + 0.5).astype(np.int64), 0, rows - 1)
+        d = (self.pacpos[:, 0] - col * main.twidth) ** 2 + (self.pacpos[:, 1] - row * main.theight) ** 2
+        hit = act & self.pellets[self.index, row, col] & (d <= (self.pacrad + self.pelletrad) ** 2)
+        idx, row, col = self.index[hit], row[hit], col[hit]
+        self.pellets[idx, row, col] = False
+        self.remaining[idx] -= 1
+        self.eaten[idx] += 1
+        self.score[idx] += self.points0[row, col]
+        self.startFreight(idx[self.points0[row, col] > 10])
+        cleared = hit & (self.remaining == 0)
+        self.cleared |= cleared
+        self.done |= cleared
+
+    def startFreight(self, idx):
+        mode = self.gmode[idx]
+        scared = (mode == main.SCATTER) | (mode == main.CHASE) | (mode == main.FREIGHT)
+        self.gtimer[idx] = np.where(scared, 0, self.gtimer[idx])
+        self.gmode[idx] = np.where(scared, main.FREIGHT, mode)
+        self.points[idx] = 200
+
+    def setPause(self, mask, pauseTime, after):
+        self.paused[mask] = True
+        self.pausetime[mask] = pauseTime * self.pausescale
+        self.pausetimer[mask] = 0
+        self.after[mask] = after
+
+    def collideGhosts(self, act):
+        r = (self.pacrad + self.ghostrad) ** 2
+        for g in range(len(self.ghostclasses)):
+            hit = act & (((self.pacpos - self.gpos[:, g]) ** 2).sum(1) <= r)
+            eaten = hit & (self.gmode[:, g] == main.FREIGHT)
+            self.score[eaten] += self.points[eaten]
+            self.points[eaten] *= 2
+            self.gmode[eaten, g] = main.SPAWN
+            self.setPause(eaten, 1, SHOW)
+            killed = hit & ~eaten & (self.gmode[:, g] != main.SPAWN) & self.alive
+            self.lives[killed] -= 1
+            self.alive[killed] = False
+            self.pacdir[killed] = STOP
+            self.setPause(killed & (self.lives > 0), 3, RESET)
+            self.setPause(killed & (self.lives <= 0), 3, GAMEOVER)
+
+    def collideFruit(self, act):
+        spawn = act & (self.fruittimer < 0) & ((self.eaten == 50) | (self.eaten == 140))
+        self.fruittimer[spawn] = 0
+        present = act & (self.fruittimer >= 0)
+        hit = present & (((self.pacpos - self.fruitpos) ** 2).sum(1) <= (self.pacrad + self.fruitrad) ** 2)
+        self.score[hit] += self.fruitpoints
+        self.fruittimer[hit | (present & (self.fruittimer >= self.fruitlifespan))] = -1
+
+    def updatePause(self):
+        waiting = self.paused & ~self.done
+        self.pausetimer[waiting] += self.dt
+        fire = waiting & (self.pausetimer >= self.pausetime)
+        self.paused[fire] = False
+        self.resetPositions(self.index[fire & (self.after == RESET)])
+        self.done |= fire & (self.after == GAMEOVER)